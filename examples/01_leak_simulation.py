@@ -3,8 +3,12 @@ Example 1: Simple leak simulation
 
 This program intentionally leaks memory by creating objects that are never freed.
 Great for testing leak detection.
+
+Pass "arena" to carve the leaked blocks out of one backing buffer instead
+of allocating each separately, and compare the two traces.
 """
 
+import sys
 import time
 
 
@@ -32,8 +36,36 @@ def leak_memory():
     return leaked
 
 
+def leak_memory_arena():
+    """Leak the same blocks, sliced from a single backing allocation."""
+    print("Starting memory leak simulation (arena mode)...")
+    print("Creating one 100KB arena split into 100 views of 1KB each...")
+    
+    # One allocation; each block is a view, not a separate buffer
+    backing = memoryview(bytearray(100 * 1024))
+    leaked = []
+    
+    for i in range(100):
+        data = backing[i * 1024:(i + 1) * 1024]
+        leaked.append(data)
+        
+        if (i + 1) % 10 == 0:
+            print(f"  Leaked {i + 1} objects ({(i + 1) * 1024} bytes)")
+        
+        time.sleep(0.01)  # Small delay to spread allocations
+    
+    print(f"Total leaked: {len(leaked)} objects ({len(leaked) * 1024:,} bytes)")
+    print("These objects will never be freed!")
+    
+    # Keep references alive
+    return leaked
+
+
 def main():
-    leaked_objects = leak_memory()
+    if "arena" in sys.argv[1:]:
+        leaked_objects = leak_memory_arena()
+    else:
+        leaked_objects = leak_memory()
     
     # Do some other work
     print("\nDoing other work...")
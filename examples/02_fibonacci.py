@@ -6,6 +6,7 @@ Tests stack trace capturing with deep call stacks.
 
 import time
 import sys
+import functools
 
 
 def fibonacci(n):
@@ -25,6 +26,22 @@ def fibonacci_with_allocation(n):
     return fibonacci_with_allocation(n - 1) + fibonacci_with_allocation(n - 2)
 
 
+@functools.lru_cache(maxsize=None)
+def fibonacci_memoized(n):
+    """Memoized recursive fibonacci - O(n) calls instead of O(2^n)."""
+    if n <= 1:
+        return n
+    return fibonacci_memoized(n - 1) + fibonacci_memoized(n - 2)
+
+
+def fibonacci_iter(n):
+    """Iterative fibonacci - O(n) time, constant stack."""
+    a, b = 0, 1
+    for _ in range(n):
+        a, b = b, a + b
+    return a
+
+
 def main():
     print("Fibonacci with deep recursion and allocations")
     print("=" * 50)
@@ -40,6 +57,15 @@ def main():
         print(f"  Result: {result}")
         print(f"  Time: {elapsed:.4f}s")
     
+    # Same results without the exponential call tree, for comparison
+    print("\nMemoized and iterative versions:")
+    for n in [20, 30]:
+        start = time.time()
+        memoized = fibonacci_memoized(n)
+        iterative = fibonacci_iter(n)
+        elapsed = time.time() - start
+        print(f"  fibonacci({n}) = {iterative} (memoized: {memoized}) in {elapsed:.6f}s")
+    
     print("\nDone!")
 
 
@@ -2,8 +2,12 @@
 Example 4: Many small allocations
 
 Tests handling of high allocation rates.
+
+Pass "arena" to hand out views of one backing buffer instead of allocating
+each object separately, and compare the two traces.
 """
 
+import sys
 import time
 
 
@@ -34,6 +38,34 @@ def many_small_allocations():
     print("Done!")
 
 
+def many_small_allocations_arena():
+    """Hand out the same small buffers as views of one allocation."""
+    print("Many small allocations test (arena mode)")
+    print("=" * 50)
+    
+    print("\nCreating 10,000 small views over one arena...")
+    start = time.time()
+    
+    # One allocation; each object is a 100 byte view into it
+    backing = memoryview(bytearray(100 * 10000))
+    objects = []
+    for i in range(10000):
+        obj = backing[i * 100:(i + 1) * 100]
+        objects.append(obj)
+        
+        if (i + 1) % 1000 == 0:
+            print(f"  Created {i + 1} objects...")
+    
+    elapsed = time.time() - start
+    print(f"\nCreated 10,000 objects in {elapsed:.4f}s")
+    print(f"Rate: {10000 / elapsed:.0f} allocations/second")
+    
+    # Clean up
+    print("\nCleaning up...")
+    objects.clear()
+    print("Done!")
+
+
 def list_comprehension_test():
     """Test list comprehensions (fast allocation)."""
     print("\n" + "=" * 50)
@@ -60,7 +92,10 @@ def list_comprehension_test():
 
 
 def main():
-    many_small_allocations()
+    if "arena" in sys.argv[1:]:
+        many_small_allocations_arena()
+    else:
+        many_small_allocations()
     list_comprehension_test()
 
 
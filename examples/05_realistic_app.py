@@ -4,34 +4,47 @@ Example 5: Real-world simulation
 Simulates a more realistic application with mixed allocation patterns.
 """
 
+import os
 import time
-import random
+from array import array
+from collections import OrderedDict
 
 
-class User:
-    """Simple user class."""
-    def __init__(self, user_id, name, email):
-        self.user_id = user_id
-        self.name = name
-        self.email = email
-        self.data = bytearray(512)  # Some user data
+class UserBatch:
+    """Users stored column-wise: one sequence per field plus a shared data blob."""
+    DATA_SIZE = 512  # Bytes of user data per user
+    
+    def __init__(self, count):
+        self.user_ids = array('q', range(count))
+        self.names = [f"User_{i}" for i in range(count)]
+        self.emails = [f"user{i}@example.com" for i in range(count)]
+        self.data = bytearray(count * self.DATA_SIZE)  # Some user data
+    
+    def user_data(self, index):
+        """View of one user's slice of the shared data blob."""
+        start = index * self.DATA_SIZE
+        return memoryview(self.data)[start:start + self.DATA_SIZE]
 
 
 class Cache:
-    """Simple cache that can leak if not managed properly."""
+    """Simple LRU cache that can leak if not managed properly."""
     def __init__(self, max_size=100):
         self.max_size = max_size
-        self.cache = {}
+        self.cache = OrderedDict()
     
     def set(self, key, value):
-        if len(self.cache) >= self.max_size:
-            # Remove oldest (simplified - should use LRU)
-            oldest = list(self.cache.keys())[0]
-            del self.cache[oldest]
+        if key in self.cache:
+            self.cache.move_to_end(key)
         self.cache[key] = value
+        if len(self.cache) > self.max_size:
+            # Evict least recently used in O(1)
+            self.cache.popitem(last=False)
     
     def get(self, key):
-        return self.cache.get(key)
+        value = self.cache.get(key)
+        if value is not None:
+            self.cache.move_to_end(key)
+        return value
 
 
 def process_users(count=1000):
@@ -40,19 +53,18 @@ def process_users(count=1000):
     
     cache = Cache(max_size=50)
     
+    # Create all users up front as columns instead of one object each
+    users = UserBatch(count)
+    
+    # Generate every iteration's scratch bytes in one allocation
+    temp_pool = memoryview(os.urandom(count * 100))
+    
     for i in range(count):
-        # Create user
-        user = User(
-            user_id=i,
-            name=f"User_{i}",
-            email=f"user{i}@example.com"
-        )
-        
         # Simulate processing
-        cache.set(user.user_id, user)
+        cache.set(users.user_ids[i], users.user_data(i))
         
         # Simulate some work
-        temp_data = [random.randint(0, 255) for _ in range(100)]
+        temp_data = temp_pool[i * 100:(i + 1) * 100]
         
         if (i + 1) % 100 == 0:
             print(f"  Processed {i + 1} users, cache size: {len(cache.cache)}")
@@ -64,18 +76,19 @@ def simulate_api_requests(num_requests=500):
     """Simulate API request handling."""
     print(f"\nSimulating {num_requests} API requests...")
     
-    responses = []
+    # One column per response field, with a single 1KB-striped data buffer
+    responses = {
+        "id": array('q'),
+        "status": [],
+        "data": bytearray(num_requests * 1024),  # 1KB per response
+        "timestamp": array('d'),
+    }
     
     for i in range(num_requests):
-        # Create response data
-        response = {
-            "id": i,
-            "status": "ok",
-            "data": bytearray(1024),  # 1KB response
-            "timestamp": time.time(),
-        }
-        
-        responses.append(response)
+        # Record response
+        responses["id"].append(i)
+        responses["status"].append("ok")
+        responses["timestamp"].append(time.time())
         
         # Simulate processing time
         time.sleep(0.001)
@@ -8,82 +8,97 @@ Usage:
 
 import sys
 import argparse
-import subprocess
 import os
 
 
 def cmd_record(args):
     """Record command: trace a program execution."""
+    import types
+    from .tracer import start
+    
     # Build command to run
     if not args.command:
         print("Error: No command specified")
         print("Usage: memlyze record <command> [args...]")
         return 1
     
-    # Get absolute paths (use raw strings in wrapper, so don't escape here)
     output_path = os.path.abspath(args.output)
     cwd = os.getcwd()
     script_path = os.path.abspath(args.command[1])
     
-    # Create wrapper script with raw strings for Windows paths
-    wrapper_code = f"""
-import sys
-import memlyze
-
-# Start tracing
-tracer = memlyze.start(
-    output_file=r'''{output_path}''',
-    sample_rate={args.sample_rate},
-    max_stack_depth={args.max_stack_depth},
-    track_gc={args.track_gc}
-)
-
-# Inject path for the script
-sys.path.insert(0, r'''{cwd}''')
-
-# Run the target script
-try:
-    with open(r'''{script_path}''', 'r', encoding='utf-8') as f:
-        code = f.read()
-    exec(compile(code, r'''{script_path}''', 'exec'), {{'__name__': '__main__', '__file__': r'''{script_path}'''}})
-finally:
-    tracer.stop()
-"""
+    # Run the target script in this interpreter, as if invoked directly.
+    # Compile it before tracing starts and exec the code object, so no
+    # runpy, pkgutil or importlib frames (which differ between Python
+    # versions) are traced as the script's allocations
+    with open(script_path, 'rb') as f:
+        code = compile(f.read(), script_path, 'exec')
+    main = types.ModuleType('__main__')
+    main.__file__ = script_path
+    main.__cached__ = None
+    sys.argv = [script_path] + args.command[2:]
+    sys.path.insert(0, cwd)
+    saved_main = sys.modules['__main__']
+    sys.modules['__main__'] = main
     
-    # Write wrapper to temp file
-    wrapper_file = ".memlyze_wrapper.py"
-    with open(wrapper_file, 'w') as f:
-        f.write(wrapper_code)
+    # Start tracing
+    tracer = start(
+        output_file=output_path,
+        sample_rate=args.sample_rate,
+        max_stack_depth=args.max_stack_depth,
+        track_gc=args.track_gc,
+        compress=args.compress
+    )
     
     try:
-        # Run Python with wrapper
-        cmd = [args.command[0], wrapper_file] + args.command[2:]
-        result = subprocess.run(cmd)
-        return result.returncode
+        exec(code, main.__dict__)
+    except SystemExit as e:
+        # sys.exit() in the script ends the script, not the tracer
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        print(e.code, file=sys.stderr)
+        return 1
     finally:
-        # Clean up wrapper
-        if os.path.exists(wrapper_file):
-            os.remove(wrapper_file)
+        # The script's globals stay alive until the final snapshot
+        tracer.stop()
+        sys.modules['__main__'] = saved_main
+    
+    return 0
 
 
 def cmd_analyze(args):
     """Analyze command: open trace file in analyzer."""
+    # Collect output and emit it with one write instead of a print per line
+    out = []
+    try:
+        return _analyze(args, out)
+    finally:
+        _write_lines(out)
+
+
+def _analyze(args, out):
+    """Run the analyze command, appending output lines to out."""
+    import heapq
+    import mmap
     import struct
-    import json
-    from collections import defaultdict
+    try:
+        import orjson as json  # Optional: faster, and decodes bytes directly
+    except ImportError:
+        import json
+    from ._parse import parse_events, InflateReader, HEADER_STRUCT
+    from .format import TraceFormat
     
-    print("\n" + _color("="*70, "cyan"))
-    print(_color("  Memlyze v0.1.0", "cyan", bold=True) + _color(" | Trace Analyzer", "white"))
-    print(_color("="*70, "cyan"))
-    print(_color("  TRACE FILE", "yellow", bold=True))
-    print(_color("  └─", "white") + f" {args.trace_file}")
-    print(_color("="*70, "cyan"))
+    out.append("\n" + _color("="*70, "cyan"))
+    out.append(_color("  Memlyze v0.1.0", "cyan", bold=True) + _color(" | Trace Analyzer", "white"))
+    out.append(_color("="*70, "cyan"))
+    out.append(_color("  TRACE FILE", "yellow", bold=True))
+    out.append(_color("  └─", "white") + f" {args.trace_file}")
+    out.append(_color("="*70, "cyan"))
     
     # Check if file exists
     if not os.path.exists(args.trace_file):
-        print(_color("\n  ERROR", "red", bold=True))
-        print(_color("  └─", "white") + " File not found: " + _color(args.trace_file, "red"))
-        print(_color("="*70, "cyan") + "\n")
+        out.append(_color("\n  ERROR", "red", bold=True))
+        out.append(_color("  └─", "white") + " File not found: " + _color(args.trace_file, "red"))
+        out.append(_color("="*70, "cyan") + "\n")
         return 1
     
     # Get file info
@@ -92,215 +107,233 @@ def cmd_analyze(args):
     size_mb = size_kb / 1024
     size_str = f"{size_mb:.2f} MB" if size_mb >= 1 else f"{size_kb:.2f} KB"
     
-    print(_color("\n  FILE INFO", "yellow", bold=True))
-    print(_color("  ├─", "white") + f" Size           : {file_size:,} bytes ({size_str})")
+    out.append(_color("\n  FILE INFO", "yellow", bold=True))
+    out.append(_color("  ├─", "white") + f" Size           : {file_size:,} bytes ({size_str})")
     
     # Parse trace file
     try:
         with open(args.trace_file, 'rb') as f:
             # Read header
-            magic = f.read(4)
-            if magic != b'MTRC':
-                print(_color("  └─", "white") + " Format         : " + _color("Invalid file format", "red"))
-                print(_color("="*70, "cyan") + "\n")
+            header = f.read(256)
+            if header[:4] != b'MTRC':
+                out.append(_color("  └─", "white") + " Format         : " + _color("Invalid file format", "red"))
+                out.append(_color("="*70, "cyan") + "\n")
                 return 1
             
-            print(_color("  ├─", "white") + " Format         : " + _color("Valid Memlyze file", "green"))
+            out.append(_color("  ├─", "white") + " Format         : " + _color("Valid Memlyze file", "green"))
             
-            version = struct.unpack('I', f.read(4))[0]
-            start_time = struct.unpack('Q', f.read(8))[0]
-            metadata_len = struct.unpack('I', f.read(4))[0]
+            _, version, start_time, metadata_len = HEADER_STRUCT.unpack_from(header, 0)
             
-            print(_color("  └─", "white") + f" Version        : {version}")
+            out.append(_color("  └─", "white") + f" Version        : {version}")
             
-            # Skip to metadata
-            f.seek(256)
-            metadata_json = f.read(metadata_len)
-            metadata = json.loads(metadata_json.decode('utf-8'))
+            # Version 1 keeps metadata as JSON right after the header;
+            # version 2 appends packed tables after the event stream and
+            # records their offset (0 if the trace was never closed)
+            metadata = None
+            metadata_offset = 0
+            flags = 0
+            if version < 2:
+                metadata_json = f.read(metadata_len)
+                metadata = TraceFormat.decode_json_metadata(json.loads(metadata_json))
+            else:
+                (flags,) = struct.unpack_from('<I', header, TraceFormat.FLAGS_POS)
+                (metadata_offset,) = struct.unpack_from('<Q', header, TraceFormat.METADATA_OFFSET_POS)
             
-            # Parse events
-            events = []
-            allocations = {}  # address -> info
-            alloc_by_stack = defaultdict(lambda: {'count': 0, 'total_bytes': 0})
-            current_time = start_time
+            events_offset = f.tell()
+            stream_len = metadata_offset - events_offset if metadata_offset else None
             
-            event_count = 0
-            alloc_count = 0
-            free_count = 0
-            gc_count = 0
+            # Map the file so the parser indexes the event stream in place and
+            # the OS handles readahead; fall back to chunked reads into a
+            # bytearray where the file cannot be mapped. A compressed stream
+            # is always inflated chunk by chunk.
+            compressed = flags & TraceFormat.FLAG_ZLIB
+            mm = None
+            if not compressed:
+                try:
+                    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                except (ValueError, OSError):
+                    pass
             
-            while True:
-                event_type_bytes = f.read(1)
-                if not event_type_bytes:
-                    break
-                
-                event_type = event_type_bytes[0]
-                event_count += 1
-                
-                # Read timestamp delta (varint)
-                delta = _read_varint(f)
-                current_time += delta
-                
-                if event_type == 0:  # ALLOC
-                    address = struct.unpack('Q', f.read(8))[0]
-                    size = _read_varint(f)
-                    stack_id = _read_varint(f)
-                    thread_id = struct.unpack('H', f.read(2))[0]
-                    
-                    allocations[address] = {
-                        'size': size,
-                        'stack_id': stack_id,
-                        'time': current_time,
-                        'freed': False
-                    }
-                    
-                    alloc_by_stack[stack_id]['count'] += 1
-                    alloc_by_stack[stack_id]['total_bytes'] += size
-                    alloc_count += 1
-                    
-                elif event_type == 1:  # FREE
-                    address = struct.unpack('Q', f.read(8))[0]
-                    if address in allocations:
-                        allocations[address]['freed'] = True
-                    free_count += 1
-                    
-                elif event_type == 2:  # GC
-                    objects = _read_varint(f)
-                    bytes_freed = _read_varint(f)
-                    gc_count += 1
+            if mm is not None:
+                with mm:
+                    if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                        mm.madvise(mmap.MADV_SEQUENTIAL)  # Strictly forward scan
+                    summary = parse_events(mm, events_offset, start_time, limit=stream_len)
+                    if metadata_offset:
+                        metadata = TraceFormat.decode_metadata(mm, metadata_offset)
+            elif compressed:
+                summary = parse_events(bytearray(), 0, start_time,
+                                       InflateReader(f, stream_len))
+            else:
+                summary = parse_events(bytearray(), 0, start_time, f, stream_len)
+            
+            if mm is None and metadata_offset:
+                f.seek(metadata_offset)
+                metadata = TraceFormat.decode_metadata(f.read(), 0)
+            
+            if metadata is None:
+                metadata = {"stack_traces": [], "files": [], "functions": []}
+            stack_counts = summary['stack_counts']
+            stack_totals = summary['stack_totals']
             
             # Analysis
-            print(_color("\n  EVENTS PARSED", "yellow", bold=True))
-            print(_color("  ├─", "white") + f" Total Events   : {event_count:,}")
-            print(_color("  ├─", "white") + f" Allocations    : {alloc_count:,}")
-            print(_color("  ├─", "white") + f" Deallocations  : {free_count:,}")
-            print(_color("  └─", "white") + f" GC Events      : {gc_count:,}")
+            out.append(_color("\n  EVENTS PARSED", "yellow", bold=True))
+            out.append(_color("  ├─", "white") + f" Total Events   : {summary['event_count']:,}")
+            out.append(_color("  ├─", "white") + f" Allocations    : {summary['alloc_count']:,}")
+            out.append(_color("  ├─", "white") + f" Deallocations  : {summary['free_count']:,}")
+            out.append(_color("  └─", "white") + f" GC Events      : {summary['gc_count']:,}")
             
             # Find leaks (never freed)
-            leaks = [a for a in allocations.values() if not a['freed']]
-            leaked_bytes = sum(a['size'] for a in leaks)
+            leak_count = summary['leak_count']
+            leaked_bytes = summary['leaked_bytes']
             
-            print(_color("\n  LEAK DETECTION", "yellow", bold=True))
-            print(_color("  ├─", "white") + f" Still Allocated: " + 
-                  _color(f"{len(leaks):,}", "red" if len(leaks) > 0 else "green"))
-            print(_color("  └─", "white") + f" Total Size     : " + 
-                  _color(f"{leaked_bytes:,} bytes ({leaked_bytes/1024:.1f} KB)", 
-                         "red" if leaked_bytes > 0 else "green"))
+            out.append(_color("\n  LEAK DETECTION", "yellow", bold=True))
+            out.append(_color("  ├─", "white") + f" Still Allocated: " + 
+                       _color(f"{leak_count:,}", "red" if leak_count > 0 else "green"))
+            out.append(_color("  └─", "white") + f" Total Size     : " + 
+                       _color(f"{leaked_bytes:,} bytes ({leaked_bytes/1024:.1f} KB)", 
+                              "red" if leaked_bytes > 0 else "green"))
             
             # Top allocators
-            if alloc_by_stack:
-                sorted_stacks = sorted(alloc_by_stack.items(), 
-                                     key=lambda x: x[1]['total_bytes'], 
-                                     reverse=True)[:5]
+            if summary['alloc_count']:
+                sorted_stacks = heapq.nlargest(
+                    5,
+                    (i for i in range(len(stack_counts)) if stack_counts[i]),
+                    key=stack_totals.__getitem__)
+                
+                # Sum once rather than for every row; "or 1" guards all-zero sizes
+                grand_total = sum(stack_totals) or 1
+                
+                # Resolve display names only for the rows shown
+                stack_traces = metadata['stack_traces']
+                files = metadata['files']
+                functions = metadata['functions']
+                basenames = {}
                 
-                print(_color("\n  TOP ALLOCATORS", "yellow", bold=True))
-                for i, (stack_id, info) in enumerate(sorted_stacks, 1):
-                    stack_str = str(stack_id)
-                    if stack_str in metadata.get('stack_traces', {}):
-                        frames = metadata['stack_traces'][stack_str]
-                        if frames:
-                            first_frame = frames[0]
-                            file_id = str(first_frame.get('file_id', ''))
-                            func_id = str(first_frame.get('func_id', ''))
-                            line = first_frame.get('line', 0)
-                            
-                            filename = metadata.get('files', {}).get(file_id, 'unknown')
-                            funcname = metadata.get('functions', {}).get(func_id, 'unknown')
-                            
-                            location = f"{os.path.basename(filename)}:{line} {funcname}()"
-                        else:
-                            location = "unknown"
-                    else:
-                        location = f"stack_{stack_id}"
+                out.append(_color("\n  TOP ALLOCATORS", "yellow", bold=True))
+                for i, stack_id in enumerate(sorted_stacks, 1):
+                    total_bytes = stack_totals[stack_id]
+                    location = _stack_location(stack_id, stack_traces, files,
+                                               functions, basenames)
                     
-                    pct = (info['total_bytes'] / sum(s['total_bytes'] for s in alloc_by_stack.values())) * 100
+                    pct = (total_bytes / grand_total) * 100
                     prefix = "  └─" if i == len(sorted_stacks) else "  ├─"
                     
-                    print(_color(prefix, "white") + 
-                          f" #{i}: {info['total_bytes']:>10,} bytes ({pct:>5.1f}%) - {location[:50]}")
+                    out.append(_color(prefix, "white") + 
+                               f" #{i}: {total_bytes:>10,} bytes ({pct:>5.1f}%) - {location[:50]}")
             
             # Memory statistics
-            total_allocated = sum(a['size'] for a in allocations.values())
-            total_freed = sum(a['size'] for a in allocations.values() if a['freed'])
+            total_allocated = summary['total_allocated']
+            total_freed = summary['total_freed']
             
-            print(_color("\n  MEMORY STATISTICS", "yellow", bold=True))
-            print(_color("  ├─", "white") + f" Total Allocated: {total_allocated:,} bytes ({total_allocated/1024:.1f} KB)")
-            print(_color("  ├─", "white") + f" Total Freed    : {total_freed:,} bytes ({total_freed/1024:.1f} KB)")
-            print(_color("  └─", "white") + f" Still in Use   : {leaked_bytes:,} bytes ({leaked_bytes/1024:.1f} KB)")
+            out.append(_color("\n  MEMORY STATISTICS", "yellow", bold=True))
+            out.append(_color("  ├─", "white") + f" Total Allocated: {total_allocated:,} bytes ({total_allocated/1024:.1f} KB) cumulative")
+            out.append(_color("  ├─", "white") + f" Total Freed    : {total_freed:,} bytes ({total_freed/1024:.1f} KB) cumulative")
+            out.append(_color("  └─", "white") + f" Still in Use   : {leaked_bytes:,} bytes ({leaked_bytes/1024:.1f} KB) live at end")
+            # Events without a real address (ALLOC_V2, FREE of address 0)
+            # share one live entry, so the totals need not reconcile with it
+            if total_allocated - total_freed != leaked_bytes:
+                out.append(_color("     Note: allocations without an address cannot be matched to frees,", "white"))
+                out.append(_color("     so the cumulative totals do not add up to what is still in use", "white"))
             
             # Recommendations
             if leaked_bytes > 1024 * 1024:  # > 1MB
-                print(_color("\n  RECOMMENDATIONS", "yellow", bold=True))
-                print(_color("  └─", "white") + _color(" CRITICAL: ", "red", bold=True) + 
-                      f"Significant memory leak detected ({leaked_bytes/1024/1024:.1f} MB)")
+                out.append(_color("\n  RECOMMENDATIONS", "yellow", bold=True))
+                out.append(_color("  └─", "white") + _color(" CRITICAL: ", "red", bold=True) + 
+                           f"Significant memory leak detected ({leaked_bytes/1024/1024:.1f} MB)")
             elif leaked_bytes > 100 * 1024:  # > 100KB
-                print(_color("\n  RECOMMENDATIONS", "yellow", bold=True))
-                print(_color("  └─", "white") + _color(" WARNING: ", "yellow", bold=True) + 
-                      f"Potential memory leak ({leaked_bytes/1024:.1f} KB)")
+                out.append(_color("\n  RECOMMENDATIONS", "yellow", bold=True))
+                out.append(_color("  └─", "white") + _color(" WARNING: ", "yellow", bold=True) + 
+                           f"Potential memory leak ({leaked_bytes/1024:.1f} KB)")
             
     except Exception as e:
-        print(_color("\n  ERROR", "red", bold=True))
-        print(_color("  └─", "white") + f" Failed to parse: {str(e)}")
-        print(_color("="*70, "cyan") + "\n")
+        out.append(_color("\n  ERROR", "red", bold=True))
+        out.append(_color("  └─", "white") + f" Failed to parse: {str(e)}")
+        out.append(_color("="*70, "cyan") + "\n")
         return 1
     
-    print(_color("="*70, "cyan"))
-    print(_color("  Analysis complete. Use --detailed for more info (coming soon)", "white", dim=True))
-    print(_color("="*70, "cyan") + "\n")
+    out.append(_color("="*70, "cyan"))
+    out.append(_color("  Analysis complete. Use --detailed for more info (coming soon)", "white", dim=True))
+    out.append(_color("="*70, "cyan") + "\n")
     return 0
 
 
-def _read_varint(f):
-    """Read a varint from file."""
-    result = 0
-    shift = 0
-    while True:
-        byte_data = f.read(1)
-        if not byte_data:
-            return 0
-        byte = byte_data[0]
-        result |= (byte & 0x7F) << shift
-        if (byte & 0x80) == 0:
-            break
-        shift += 7
-    return result
+def _stack_location(stack_id, stack_traces, files, functions, basenames):
+    """Describe a stack by its first frame as 'file.py:line func()'."""
+    if stack_id >= len(stack_traces) or stack_traces[stack_id] is None:
+        return f"stack_{stack_id}"
+    frames = stack_traces[stack_id]
+    if not frames:
+        return "unknown"
+    
+    file_id, line, func_id = frames[0]
+    filename = files[file_id] if 0 <= file_id < len(files) else None
+    funcname = functions[func_id] if 0 <= func_id < len(functions) else None
+    if filename is None:
+        filename = 'unknown'
+    if funcname is None:
+        funcname = 'unknown'
+    
+    # Stacks often share files, so only parse each path once
+    basename = basenames.get(filename)
+    if basename is None:
+        basename = basenames[filename] = os.path.basename(filename)
+    
+    return f"{basename}:{line} {funcname}()"
 
 
 def cmd_serve(args):
     """Serve command: start web UI server."""
-    print("\n" + _color("="*70, "cyan"))
-    print(_color("  Memlyze v0.1.0", "cyan", bold=True) + _color(" | Web Server", "white"))
-    print(_color("="*70, "cyan"))
-    print(_color("  TRACE FILE", "yellow", bold=True))
-    print(_color("  └─", "white") + f" {args.trace_file}")
-    print(_color("="*70, "cyan"))
+    # Collect output and emit it with one write instead of a print per line
+    out = []
+    try:
+        return _serve(args, out)
+    finally:
+        _write_lines(out)
+
+
+def _serve(args, out):
+    """Run the serve command, appending output lines to out."""
+    out.append("\n" + _color("="*70, "cyan"))
+    out.append(_color("  Memlyze v0.1.0", "cyan", bold=True) + _color(" | Web Server", "white"))
+    out.append(_color("="*70, "cyan"))
+    out.append(_color("  TRACE FILE", "yellow", bold=True))
+    out.append(_color("  └─", "white") + f" {args.trace_file}")
+    out.append(_color("="*70, "cyan"))
     
     # Check if file exists
     if not os.path.exists(args.trace_file):
-        print(_color("\n  ERROR", "red", bold=True))
-        print(_color("  └─", "white") + " File not found: " + _color(args.trace_file, "red"))
-        print(_color("="*70, "cyan") + "\n")
+        out.append(_color("\n  ERROR", "red", bold=True))
+        out.append(_color("  └─", "white") + " File not found: " + _color(args.trace_file, "red"))
+        out.append(_color("="*70, "cyan") + "\n")
         return 1
     
-    print(_color("\n  WEB UI STATUS", "yellow", bold=True))
-    print(_color("  └─", "white") + " Phase 3 web interface not yet implemented")
+    out.append(_color("\n  WEB UI STATUS", "yellow", bold=True))
+    out.append(_color("  └─", "white") + " Phase 3 web interface not yet implemented")
     
-    print(_color("\n  COMING SOON", "yellow", bold=True))
-    print(_color("  ├─", "white") + " Interactive timeline (scrubbing, zoom)")
-    print(_color("  ├─", "white") + " Memory heatmaps and treemaps")
-    print(_color("  ├─", "white") + " Click-to-code navigation")
-    print(_color("  ├─", "white") + " Real-time filtering and search")
-    print(_color("  └─", "white") + f" Local server on http://localhost:{args.port}")
+    out.append(_color("\n  COMING SOON", "yellow", bold=True))
+    out.append(_color("  ├─", "white") + " Interactive timeline (scrubbing, zoom)")
+    out.append(_color("  ├─", "white") + " Memory heatmaps and treemaps")
+    out.append(_color("  ├─", "white") + " Click-to-code navigation")
+    out.append(_color("  ├─", "white") + " Real-time filtering and search")
+    out.append(_color("  └─", "white") + f" Local server on http://localhost:{args.port}")
     
-    print(_color("\n  CURRENT OPTIONS", "yellow", bold=True))
-    print(_color("  └─", "white") + " Terminal UI    : " + _color(f"memtrace analyze {args.trace_file}", "green"))
+    out.append(_color("\n  CURRENT OPTIONS", "yellow", bold=True))
+    out.append(_color("  └─", "white") + " Terminal UI    : " + _color(f"memtrace analyze {args.trace_file}", "green"))
     
-    print(_color("="*70, "cyan"))
-    print(_color("  Track progress at: github.com/yourusername/memtrace", "white", dim=True))
-    print(_color("="*70, "cyan") + "\n")
+    out.append(_color("="*70, "cyan"))
+    out.append(_color("  Track progress at: github.com/yourusername/memtrace", "white", dim=True))
+    out.append(_color("="*70, "cyan") + "\n")
     return 0
 
 
+def _write_lines(lines):
+    """Write buffered output lines to stdout in a single call."""
+    if lines:
+        sys.stdout.write("\n".join(lines) + "\n")
+        sys.stdout.flush()
+
+
 def main():
     """Main CLI entry point."""
     parser = argparse.ArgumentParser(
@@ -321,6 +354,8 @@ def main():
                               help='Maximum stack depth (default: 10)')
     record_parser.add_argument('--no-track-gc', dest='track_gc', action='store_false',
                               help='Disable GC tracking')
+    record_parser.add_argument('--compress', action='store_true',
+                              help='Compress the event stream with zlib')
     record_parser.set_defaults(func=cmd_record, track_gc=True)
     
     # Analyze command (Phase 2)
@@ -346,31 +381,34 @@ def main():
     return args.func(args)
 
 
+_COLOR_CODES = {
+    "black": "30",
+    "red": "31",
+    "green": "32",
+    "yellow": "33",
+    "blue": "34",
+    "magenta": "35",
+    "cyan": "36",
+    "white": "37",
+}
+
+# Escape prefix for every (color, bold, dim) combination, built once
+_COLOR_PREFIXES = {
+    (color, bold, dim): "\033[" + ";".join(
+        (["1"] if bold else []) + (["2"] if dim else []) + [code]
+    ) + "m"
+    for color, code in _COLOR_CODES.items()
+    for bold in (False, True)
+    for dim in (False, True)
+}
+
+
 def _color(text, color, bold=False, dim=False):
     """Apply ANSI color codes to text."""
-    colors = {
-        "black": "30",
-        "red": "31",
-        "green": "32",
-        "yellow": "33",
-        "blue": "34",
-        "magenta": "35",
-        "cyan": "36",
-        "white": "37",
-    }
-    
-    code = colors.get(color, "37")
-    style = []
-    
-    if bold:
-        style.append("1")
-    if dim:
-        style.append("2")
-    
-    if style:
-        return f"\033[{';'.join(style)};{code}m{text}\033[0m"
-    else:
-        return f"\033[{code}m{text}\033[0m"
+    prefix = _COLOR_PREFIXES.get((color, bold, dim))
+    if prefix is None:
+        prefix = _COLOR_PREFIXES[("white", bool(bold), bool(dim))]
+    return f"{prefix}{text}\033[0m"
 
 
 if __name__ == '__main__':
@@ -0,0 +1,220 @@
+"""
+Event stream parser used by the analyzer.
+
+Kept separate from the CLI so the hot loop only touches local names and
+the display code in __main__ works on a plain summary.
+"""
+
+import struct
+import zlib
+from array import array
+from typing import Dict, Any, Optional, BinaryIO, Tuple
+
+from .format import _ALLOC_FIXED  # Shared with the encoder so the layouts cannot drift
+
+
+READ_CHUNK_SIZE = 4 * 1024 * 1024  # 4MB per refill
+MAX_EVENT_SIZE = 64  # Upper bound on one encoded event (ALLOC is <= 41 bytes)
+
+# Precompiled layouts: magic, version, start_us, metadata_len (header flags
+# and offsets are the TraceFormat constants)
+HEADER_STRUCT = struct.Struct('<4sIQI')
+_U64 = struct.Struct('<Q')
+_U16 = struct.Struct('<H')
+
+
+def parse_events(buf,
+                 pos: int = 0,
+                 start_time: int = 0,
+                 source: Optional[BinaryIO] = None,
+                 limit: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Parse an encoded event stream.
+    
+    Args:
+        buf: Bytes-like object holding the event stream (a bytearray,
+            possibly empty, when source is given)
+        pos: Offset of the first event in buf
+        start_time: Trace start timestamp (microseconds)
+        source: Optional file to refill buf from as it is consumed
+        limit: Length of the event stream, when something follows it
+            (counted from pos, or from the current position of source)
+    
+    Returns:
+        Summary dict with event counts, leak totals and per-stack totals
+    """
+    unpack_u64 = _U64.unpack_from
+    unpack_u16 = _U16.unpack_from
+    unpack_alloc_fixed = _ALLOC_FIXED.unpack_from
+    alloc_fixed_size = _ALLOC_FIXED.size
+    read_varint = _read_varint
+    if source is None:
+        end = len(buf) if limit is None else min(len(buf), pos + limit)
+    else:
+        end = len(buf)
+        remaining = limit  # Stream bytes still to read from source
+    # Refill once fewer than MAX_EVENT_SIZE bytes remain, so a single
+    # event never straddles the end of the buffer
+    refill_at = end - MAX_EVENT_SIZE if source is not None else end
+    
+    # Only live allocations are kept (address -> (size, stack_id)), so peak
+    # memory follows the live set rather than every allocation ever seen.
+    # Whatever is still live at the end of the stream is a leak.
+    live = {}
+    total_allocated = 0
+    total_freed = 0
+    # Per-stack aggregates indexed by stack_id (IDs are dense, from 0)
+    stack_counts = array('Q')
+    stack_totals = array('Q')
+    current_time = start_time
+    
+    event_count = 0
+    alloc_count = 0
+    free_count = 0
+    gc_count = 0
+    marker_count = 0
+    
+    try:
+        while True:
+            while pos > refill_at:
+                if source is None or pos > end:
+                    raise _truncated(event_count)
+                # Deleting a bytearray prefix is amortized O(n), so dropping
+                # consumed bytes before appending keeps the refill cheap
+                del buf[:pos]
+                pos = 0
+                if remaining is None:
+                    chunk = source.read(READ_CHUNK_SIZE)
+                else:
+                    chunk = source.read(min(READ_CHUNK_SIZE, remaining))
+                    remaining -= len(chunk)
+                buf += chunk
+                end = len(buf)
+                refill_at = end - MAX_EVENT_SIZE if chunk else end
+            if pos >= end:
+                break
+            
+            event_type = buf[pos]
+            event_count += 1
+            
+            if event_type == 4:  # ALLOC_V2: fixed layout, no address
+                _, delta, size, stack_id, thread_id = unpack_alloc_fixed(buf, pos)
+                pos += alloc_fixed_size
+                address = 0
+            else:
+                # Read timestamp delta (varint)
+                delta, pos = read_varint(buf, pos + 1)
+                if event_type == 0:  # ALLOC
+                    (address,) = unpack_u64(buf, pos)
+                    size, pos = read_varint(buf, pos + 8)
+                    stack_id, pos = read_varint(buf, pos)
+                    (thread_id,) = unpack_u16(buf, pos)
+                    pos += 2
+            current_time += delta
+            
+            if event_type == 4 or event_type == 0:
+                live[address] = (size, stack_id)
+                total_allocated += size
+                
+                if stack_id >= len(stack_counts):
+                    grow = array('Q', bytes(8 * (stack_id + 1 - len(stack_counts))))
+                    stack_counts.extend(grow)
+                    stack_totals.extend(grow)
+                stack_counts[stack_id] += 1
+                stack_totals[stack_id] += size
+                alloc_count += 1
+            
+            elif event_type == 1:  # FREE
+                (address,) = unpack_u64(buf, pos)
+                pos += 8
+                freed = live.pop(address, None)
+                if freed is not None:
+                    total_freed += freed[0]
+                free_count += 1
+            
+            elif event_type == 2:  # GC
+                objects, pos = read_varint(buf, pos)
+                bytes_freed, pos = read_varint(buf, pos)
+                gc_count += 1
+            
+            elif event_type == 3:  # MARKER
+                name_id, pos = read_varint(buf, pos)
+                marker_count += 1
+    except (IndexError, struct.error):
+        # An event read past the end of buf
+        raise _truncated(event_count) from None
+    
+    return {
+        "event_count": event_count,
+        "alloc_count": alloc_count,
+        "free_count": free_count,
+        "gc_count": gc_count,
+        "marker_count": marker_count,
+        "leak_count": len(live),
+        "leaked_bytes": sum(size for size, _ in live.values()),
+        "total_allocated": total_allocated,
+        "total_freed": total_freed,
+        "stack_counts": stack_counts,
+        "stack_totals": stack_totals,
+        "end_time": current_time,
+    }
+
+
+class InflateReader:
+    """Read-only file-like view that inflates a zlib-compressed event stream."""
+    
+    def __init__(self, source: BinaryIO, length: Optional[int] = None):
+        """
+        Args:
+            source: File positioned at the start of the compressed stream
+            length: Compressed length (None: read to end of file)
+        """
+        self._source = source
+        self._remaining = length
+        self._inflate = zlib.decompressobj()
+    
+    def read(self, size: int) -> bytes:
+        """Return up to size inflated bytes; b"" at the end of the stream."""
+        inflate = self._inflate
+        while True:
+            if inflate.unconsumed_tail:
+                data = inflate.decompress(inflate.unconsumed_tail, size)
+            elif inflate.eof:
+                return b""
+            else:
+                if self._remaining is None:
+                    chunk = self._source.read(READ_CHUNK_SIZE)
+                else:
+                    chunk = self._source.read(min(READ_CHUNK_SIZE, self._remaining))
+                    self._remaining -= len(chunk)
+                if not chunk:
+                    # Truncated stream (trace never closed): keep what inflated
+                    return inflate.flush()
+                data = inflate.decompress(chunk, size)
+            if data:
+                return data
+
+
+def _truncated(event_count: int) -> ValueError:
+    """Error for an event stream that ends inside event number event_count."""
+    return ValueError(f"Truncated trace: event {event_count} runs past the end "
+                      "of the event stream (file cut short or corrupt)")
+
+
+def _read_varint(buf, pos: int) -> Tuple[int, int]:
+    """Read a varint from buf at pos. Returns (value, new_pos)."""
+    byte = buf[pos]
+    if byte < 0x80:
+        # Single-byte varints dominate (small deltas, sizes, stack IDs)
+        return byte, pos + 1
+    
+    result = byte & 0x7F
+    shift = 7
+    pos += 1
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
@@ -6,77 +6,149 @@ Format:
         - Magic: "MTRC" (4 bytes)
         - Version: uint32
         - Start timestamp: uint64 (microseconds since epoch)
-        - Metadata length: uint32
+        - Metadata length: uint32 (version 1 JSON only, 0 otherwise)
+        - Flags: uint32 (bit 0: event stream is zlib-compressed)
+        - Metadata offset: uint64 at byte 24 (0 until the trace is closed)
         - Reserved: padding to 256 bytes
-        - Metadata: JSON (stack traces, file paths, etc.)
     
     Event Stream:
         Each event is variable length:
         - Event type: uint8
         - Timestamp delta: varint
         - Payload (depends on type)
+    
+    Metadata (at metadata offset, after the event stream):
+        - Files, functions: uint32 count, then (uint32 len, utf-8 bytes)*
+        - Stack traces: uint32 count, then
+          (uint16 depth, (uint32 file_id, uint32 line, uint32 func_id)*)*
 """
 
 import struct
 import json
 from enum import IntEnum
-from typing import Dict, Any, Optional, List, Tuple
+from typing import Dict, Any, Optional, List, Sequence, Tuple
 import time
 
 
+# Precompiled little-endian layouts for fixed-width event fields
+_U64 = struct.Struct('<Q')
+_U32 = struct.Struct('<I')
+_U16 = struct.Struct('<H')
+_FRAME = struct.Struct('<III')  # file_id, line, func_id
+_ALLOC_FIXED = struct.Struct('<BIIIH')  # ALLOC_V2: type, delta, size, stack_id, thread_id
+
+# Pre-built encodings for the common single-byte varints (0-127)
+_VARINT_1BYTE = tuple(bytes((i,)) for i in range(128))
+
+
+def _encode_varint(value: int) -> bytes:
+    """Encode integer as varint. Module-level so encoders skip method dispatch."""
+    # Fast paths: most deltas, sizes and IDs fit in one or two bytes
+    if value < 0x80:
+        if value < 0:
+            raise ValueError(f"varint value must be non-negative, got {value}")
+        return _VARINT_1BYTE[value]
+    if value < 0x4000:
+        return bytes(((value & 0x7F) | 0x80, value >> 7))
+    
+    result = bytearray()
+    while value > 127:
+        result.append((value & 0x7F) | 0x80)
+        value >>= 7
+    result.append(value & 0x7F)
+    return bytes(result)
+
+
+def _write_varint(out: bytearray, pos: int, value: int) -> int:
+    """Write a varint into out at pos without creating a bytes object. Returns the new pos."""
+    while value > 0x7F:
+        out[pos] = (value & 0x7F) | 0x80
+        value >>= 7
+        pos += 1
+    if value < 0:
+        raise ValueError(f"varint value must be non-negative, got {value}")
+    out[pos] = value
+    return pos + 1
+
+
 class EventType(IntEnum):
     """Event types in trace stream."""
     ALLOC = 0
     FREE = 1
     GC = 2
     MARKER = 3
+    ALLOC_V2 = 4  # Fixed-width allocation without address
+
+
+# Event type codes resolved once; looking up an IntEnum member costs a
+# Python-level descriptor call, which the encoders would pay per event
+_EVT_BYTES = {e: bytes((e,)) for e in EventType}
+_EVT_ALLOC = _EVT_BYTES[EventType.ALLOC]
+_EVT_FREE = _EVT_BYTES[EventType.FREE]
+_EVT_GC = _EVT_BYTES[EventType.GC]
+_EVT_MARKER = _EVT_BYTES[EventType.MARKER]
+_ALLOC, _FREE, _GC, _MARKER, _ALLOC_V2 = (int(e) for e in EventType)
 
 
 class TraceFormat:
     """Handles encoding/decoding of .mtrace binary format."""
     
     MAGIC = b"MTRC"
-    VERSION = 1
+    VERSION = 2
     HEADER_SIZE = 256
+    FLAGS_POS = 20
+    METADATA_OFFSET_POS = 24  # Header field patched with the tables' offset
+    FLAG_ZLIB = 0x1  # Event stream is one zlib stream
     
     def __init__(self):
-        self.metadata: Dict[str, Any] = {
-            "stack_traces": {},  # id -> stack trace info
-            "files": {},         # id -> file path
-            "functions": {},     # id -> function name
-        }
+        self._stacks: List[bytes] = []  # stack ID -> packed (depth, frames)
         self.next_stack_id = 0
         self.next_file_id = 0
         self.next_func_id = 0
         self.stack_cache: Dict[Tuple, int] = {}  # Cache for deduplication
+        self._file_ids: Dict[str, int] = {}  # filename -> file ID
+        self._func_ids: Dict[str, int] = {}  # function name -> function ID
+        self.frame_cache: Dict[Tuple[str, int, str], bytes] = {}  # frame -> packed frame
         
-    def create_header(self, start_timestamp: float) -> bytes:
+    def create_header(self, start_timestamp: float, compressed: bool = False) -> bytes:
         """Create trace file header."""
         # Convert timestamp to microseconds
         start_us = int(start_timestamp * 1_000_000)
         
-        # Serialize metadata to JSON
-        metadata_json = json.dumps(self.metadata).encode('utf-8')
-        metadata_len = len(metadata_json)
-        
-        # Build header
+        # Build header; metadata length stays 0 (no JSON follows the header)
+        # and the metadata offset is patched in once the trace is closed
         header = bytearray(self.HEADER_SIZE)
         struct.pack_into('4sIQ', header, 0, 
                         self.MAGIC, 
                         self.VERSION, 
                         start_us)
-        struct.pack_into('I', header, 16, metadata_len)
+        if compressed:
+            struct.pack_into('I', header, self.FLAGS_POS, self.FLAG_ZLIB)
         
-        return bytes(header) + metadata_json
+        return bytes(header)
+    
+    def encode_metadata(self) -> bytes:
+        """
+        Encode the file, function and stack trace tables.
+        
+        Written once after the last event; IDs are implicit in table order.
+        """
+        parts = []
+        # Dicts keep insertion order, which is ID order
+        for names in (self._file_ids, self._func_ids):
+            parts.append(_U32.pack(len(names)))
+            for name in names:
+                data = name.encode('utf-8', 'surrogateescape')
+                parts.append(_U32.pack(len(data)))
+                parts.append(data)
+        
+        parts.append(_U32.pack(len(self._stacks)))
+        parts.extend(self._stacks)
+        return b"".join(parts)
     
     def encode_varint(self, value: int) -> bytes:
         """Encode integer as varint (variable-length encoding)."""
-        result = bytearray()
-        while value > 127:
-            result.append((value & 0x7F) | 0x80)
-            value >>= 7
-        result.append(value & 0x7F)
-        return bytes(result)
+        return _encode_varint(value)
     
     def decode_varint(self, data: bytes, offset: int) -> Tuple[int, int]:
         """Decode varint from data at offset. Returns (value, new_offset)."""
@@ -94,38 +166,43 @@ class TraceFormat:
             
         return value, pos
     
-    def get_or_create_stack_id(self, stack_trace: List[Tuple[str, int, str]]) -> int:
+    def get_or_create_stack_id(self, stack_trace: Sequence[Tuple[str, int, str]]) -> int:
         """
         Get or create ID for a stack trace.
         
         Args:
-            stack_trace: List of (filename, lineno, function_name) tuples
+            stack_trace: (filename, lineno, function_name) tuples; pass a
+                tuple to use it as the cache key without copying
             
         Returns:
             Stack trace ID
         """
         # Create cache key
-        cache_key = tuple(stack_trace)
+        cache_key = stack_trace if type(stack_trace) is tuple else tuple(stack_trace)
         
-        if cache_key in self.stack_cache:
-            return self.stack_cache[cache_key]
+        stack_id = self.stack_cache.get(cache_key)
+        if stack_id is not None:
+            return stack_id
         
         # Create new stack trace entry
         stack_id = self.next_stack_id
         self.next_stack_id += 1
         
-        # Store in metadata with file/function IDs
-        frames = []
-        for filename, lineno, funcname in stack_trace:
-            file_id = self._get_or_create_file_id(filename)
-            func_id = self._get_or_create_func_id(funcname)
-            frames.append({
-                "file_id": file_id,
-                "line": lineno,
-                "func_id": func_id
-            })
-        
-        self.metadata["stack_traces"][str(stack_id)] = frames
+        # Pack frames with file/function IDs; frames shared between
+        # stacks are resolved once and reused
+        frames = [_U16.pack(len(stack_trace))]
+        frame_cache = self.frame_cache
+        for frame_key in stack_trace:
+            frame = frame_cache.get(frame_key)
+            if frame is None:
+                filename, lineno, funcname = frame_key
+                frame = frame_cache[frame_key] = _FRAME.pack(
+                    self._get_or_create_file_id(filename),
+                    lineno,
+                    self._get_or_create_func_id(funcname))
+            frames.append(frame)
+        
+        self._stacks.append(b"".join(frames))
         self.stack_cache[cache_key] = stack_id
         
         return stack_id
@@ -133,27 +210,27 @@ class TraceFormat:
     def _get_or_create_file_id(self, filename: str) -> int:
         """Get or create ID for a filename."""
         # Check if already exists
-        for fid, fname in self.metadata["files"].items():
-            if fname == filename:
-                return int(fid)
+        file_id = self._file_ids.get(filename)
+        if file_id is not None:
+            return file_id
         
         # Create new
         file_id = self.next_file_id
         self.next_file_id += 1
-        self.metadata["files"][str(file_id)] = filename
+        self._file_ids[filename] = file_id
         return file_id
     
     def _get_or_create_func_id(self, funcname: str) -> int:
         """Get or create ID for a function name."""
         # Check if already exists
-        for fid, fname in self.metadata["functions"].items():
-            if fname == funcname:
-                return int(fid)
+        func_id = self._func_ids.get(funcname)
+        if func_id is not None:
+            return func_id
         
         # Create new
         func_id = self.next_func_id
         self.next_func_id += 1
-        self.metadata["functions"][str(func_id)] = funcname
+        self._func_ids[funcname] = func_id
         return func_id
     
     def encode_alloc_event(self, 
@@ -172,27 +249,67 @@ class TraceFormat:
             stack_id: Stack trace ID
             thread_id: Thread ID
         """
-        result = bytearray()
-        
-        # Event type
-        result.append(EventType.ALLOC)
-        
-        # Timestamp delta (varint)
-        result.extend(self.encode_varint(timestamp_delta))
-        
-        # Address (uint64)
-        result.extend(struct.pack('Q', address))
-        
-        # Size (varint)
-        result.extend(self.encode_varint(size))
-        
-        # Stack trace ID (varint)
-        result.extend(self.encode_varint(stack_id))
-        
-        # Thread ID (uint16)
-        result.extend(struct.pack('H', thread_id))
+        return b"".join((
+            _EVT_ALLOC,                       # Event type
+            _encode_varint(timestamp_delta),  # Timestamp delta (varint)
+            _U64.pack(address),               # Address (uint64)
+            _encode_varint(size),             # Size (varint)
+            _encode_varint(stack_id),         # Stack trace ID (varint)
+            _U16.pack(thread_id),             # Thread ID (uint16)
+        ))
+    
+    def encode_alloc_event_into(self,
+                                out: bytearray,
+                                pos: int,
+                                timestamp_delta: int,
+                                address: int,
+                                size: int,
+                                stack_id: int,
+                                thread_id: int) -> int:
+        """
+        Write an allocation event into out at pos (same bytes as
+        encode_alloc_event). Returns the offset just past the event.
+        """
+        out[pos] = _ALLOC
+        pos = _write_varint(out, pos + 1, timestamp_delta)
+        _U64.pack_into(out, pos, address)
+        pos = _write_varint(out, pos + 8, size)
+        pos = _write_varint(out, pos, stack_id)
+        _U16.pack_into(out, pos, thread_id)
+        return pos + 2
+    
+    def encode_alloc_v2_event(self,
+                              timestamp_delta: int,
+                              size: int,
+                              stack_id: int,
+                              thread_id: int) -> bytes:
+        """
+        Encode an allocation event without an address.
         
-        return bytes(result)
+        Uses the fixed-width ALLOC_V2 layout, or an ALLOC event with
+        address 0 when a field does not fit in 32 bits.
+        """
+        if (timestamp_delta | size | stack_id) >> 32:
+            return self.encode_alloc_event(timestamp_delta, 0, size, stack_id, thread_id)
+        return _ALLOC_FIXED.pack(_ALLOC_V2, timestamp_delta, size, stack_id, thread_id)
+    
+    def encode_alloc_v2_event_into(self,
+                                   out: bytearray,
+                                   pos: int,
+                                   timestamp_delta: int,
+                                   size: int,
+                                   stack_id: int,
+                                   thread_id: int) -> int:
+        """
+        Write an allocation event into out at pos (same bytes as
+        encode_alloc_v2_event). Returns the offset just past the event.
+        """
+        if (timestamp_delta | size | stack_id) >> 32:
+            return self.encode_alloc_event_into(out, pos, timestamp_delta, 0,
+                                                size, stack_id, thread_id)
+        _ALLOC_FIXED.pack_into(out, pos, _ALLOC_V2, timestamp_delta,
+                               size, stack_id, thread_id)
+        return pos + _ALLOC_FIXED.size
     
     def encode_free_event(self, timestamp_delta: int, address: int) -> bytes:
         """
@@ -202,18 +319,19 @@ class TraceFormat:
             timestamp_delta: Microseconds since last event
             address: Memory address being freed
         """
-        result = bytearray()
-        
-        # Event type
-        result.append(EventType.FREE)
-        
-        # Timestamp delta (varint)
-        result.extend(self.encode_varint(timestamp_delta))
-        
-        # Address (uint64)
-        result.extend(struct.pack('Q', address))
-        
-        return bytes(result)
+        return b"".join((
+            _EVT_FREE,                        # Event type
+            _encode_varint(timestamp_delta),  # Timestamp delta (varint)
+            _U64.pack(address),               # Address (uint64)
+        ))
+    
+    def encode_free_event_into(self, out: bytearray, pos: int,
+                               timestamp_delta: int, address: int) -> int:
+        """Write a deallocation event into out at pos (same bytes as encode_free_event)."""
+        out[pos] = _FREE
+        pos = _write_varint(out, pos + 1, timestamp_delta)
+        _U64.pack_into(out, pos, address)
+        return pos + 8
     
     def encode_gc_event(self, 
                        timestamp_delta: int,
@@ -227,21 +345,24 @@ class TraceFormat:
             objects_collected: Number of objects collected
             bytes_freed: Total bytes freed
         """
-        result = bytearray()
-        
-        # Event type
-        result.append(EventType.GC)
-        
-        # Timestamp delta (varint)
-        result.extend(self.encode_varint(timestamp_delta))
-        
-        # Objects collected (varint)
-        result.extend(self.encode_varint(objects_collected))
-        
-        # Bytes freed (varint)
-        result.extend(self.encode_varint(bytes_freed))
-        
-        return bytes(result)
+        return b"".join((
+            _EVT_GC,                            # Event type
+            _encode_varint(timestamp_delta),    # Timestamp delta (varint)
+            _encode_varint(objects_collected),  # Objects collected (varint)
+            _encode_varint(bytes_freed),        # Bytes freed (varint)
+        ))
+    
+    def encode_gc_event_into(self,
+                             out: bytearray,
+                             pos: int,
+                             timestamp_delta: int,
+                             objects_collected: int,
+                             bytes_freed: int) -> int:
+        """Write a garbage collection event into out at pos (same bytes as encode_gc_event)."""
+        out[pos] = _GC
+        pos = _write_varint(out, pos + 1, timestamp_delta)
+        pos = _write_varint(out, pos, objects_collected)
+        return _write_varint(out, pos, bytes_freed)
     
     def encode_marker_event(self, timestamp_delta: int, name: str) -> bytes:
         """
@@ -251,29 +372,34 @@ class TraceFormat:
             timestamp_delta: Microseconds since last event
             name: Marker name
         """
-        result = bytearray()
-        
-        # Event type
-        result.append(EventType.MARKER)
-        
-        # Timestamp delta (varint)
-        result.extend(self.encode_varint(timestamp_delta))
-        
         # Get or create name ID
         name_id = self._get_or_create_func_id(name)  # Reuse function ID system
         
-        # Name ID (varint)
-        result.extend(self.encode_varint(name_id))
-        
-        return bytes(result)
+        return b"".join((
+            _EVT_MARKER,                      # Event type
+            _encode_varint(timestamp_delta),  # Timestamp delta (varint)
+            _encode_varint(name_id),          # Name ID (varint)
+        ))
+    
+    def encode_marker_event_into(self, out: bytearray, pos: int,
+                                 timestamp_delta: int, name: str) -> int:
+        """Write a marker event into out at pos (same bytes as encode_marker_event)."""
+        out[pos] = _MARKER
+        pos = _write_varint(out, pos + 1, timestamp_delta)
+        return _write_varint(out, pos, self._get_or_create_func_id(name))
     
     @staticmethod
     def parse_header(data: bytes) -> Tuple[Dict[str, Any], int]:
         """
         Parse trace file header.
         
+        Args:
+            data: Trace file contents (version 2 keeps its metadata
+                after the event stream, so this must be the whole file)
+        
         Returns:
-            (metadata_dict, offset_to_event_stream)
+            (metadata_dict, offset_to_event_stream); metadata holds
+            ID-indexed lists for every version (see decode_metadata)
         """
         # Check magic
         magic = data[0:4]
@@ -283,11 +409,71 @@ class TraceFormat:
         # Parse header
         version, start_us = struct.unpack_from('IQ', data, 4)
         metadata_len = struct.unpack_from('I', data, 16)[0]
-        
-        # Parse metadata JSON
         metadata_start = TraceFormat.HEADER_SIZE
+        
+        if version >= 2:
+            # Offset 0 means the trace was never closed: no tables
+            metadata_offset = _U64.unpack_from(data, TraceFormat.METADATA_OFFSET_POS)[0]
+            if not metadata_offset:
+                return {"stack_traces": [], "files": [], "functions": []}, metadata_start
+            return TraceFormat.decode_metadata(data, metadata_offset), metadata_start
+        
+        # Version 1: metadata JSON follows the header
         metadata_end = metadata_start + metadata_len
         metadata_json = data[metadata_start:metadata_end]
-        metadata = json.loads(metadata_json.decode('utf-8'))
+        metadata = json.loads(bytes(metadata_json).decode('utf-8'))
+        
+        return TraceFormat.decode_json_metadata(metadata), metadata_end
+    
+    @staticmethod
+    def decode_json_metadata(metadata: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Convert version 1 JSON metadata (dicts keyed by str(id)) to the
+        ID-indexed lists decode_metadata() returns.
+        """
+        def by_id(table):
+            return [table.get(str(i)) for i in range(len(table))]
+        
+        stack_traces = [
+            None if frames is None else
+            [(f.get('file_id', -1), f.get('line', 0), f.get('func_id', -1)) for f in frames]
+            for frames in by_id(metadata.get('stack_traces', {}))]
+        return {
+            "stack_traces": stack_traces,
+            "files": by_id(metadata.get('files', {})),
+            "functions": by_id(metadata.get('functions', {})),
+        }
+    
+    @staticmethod
+    def decode_metadata(data: bytes, offset: int) -> Dict[str, Any]:
+        """
+        Decode the tables written by encode_metadata().
         
-        return metadata, metadata_end
+        Returns:
+            Dict of ID-indexed lists: "files" and "functions" hold names,
+            "stack_traces" holds lists of (file_id, line, func_id) tuples
+        """
+        pos = offset
+        names = []
+        for _ in range(2):  # files, then functions
+            count = _U32.unpack_from(data, pos)[0]
+            pos += 4
+            table = []
+            for _ in range(count):
+                length = _U32.unpack_from(data, pos)[0]
+                pos += 4
+                table.append(bytes(data[pos:pos + length]).decode('utf-8', 'surrogateescape'))
+                pos += length
+            names.append(table)
+        
+        count = _U32.unpack_from(data, pos)[0]
+        pos += 4
+        stack_traces = []
+        for _ in range(count):
+            depth = _U16.unpack_from(data, pos)[0]
+            pos += 2
+            end = pos + depth * _FRAME.size
+            stack_traces.append(list(_FRAME.iter_unpack(data[pos:end])))
+            pos = end
+        
+        return {"stack_traces": stack_traces, "files": names[0], "functions": names[1]}
@@ -8,7 +8,9 @@ import threading
 import gc
 import sys
 import os
-from typing import Optional, List, Tuple
+import itertools
+from collections import deque
+from typing import Deque, Optional, Dict, List, Tuple
 from .format import TraceFormat
 from .writer import TraceWriter
 
@@ -16,6 +18,31 @@ from .writer import TraceWriter
 # Global tracer instance
 _active_tracer: Optional['MemoryTracer'] = None
 
+# ANSI escape sequences for the start/stop banners
+_RESET = "\033[0m"
+_RED = "\033[31m"
+_GREEN = "\033[32m"
+_YELLOW = "\033[33m"
+_WHITE = "\033[37m"
+_BOLD_RED = "\033[1;31m"
+_BOLD_GREEN = "\033[1;32m"
+_BOLD_YELLOW = "\033[1;33m"
+_BOLD_CYAN = "\033[1;36m"
+_RULE = f"\033[36m{'=' * 70}{_RESET}"
+_BRANCH = f"{_WHITE}  ├─{_RESET}"
+_LAST = f"{_WHITE}  └─{_RESET}"
+
+# Below this sample rate snapshot() only diffs every snapshot_stride-th call
+_LOW_SAMPLE_RATE = 0.01
+
+# Sites in these files are the tracer's own work (event buffers, snapshot
+# copies, the CLI running the script), not the traced program's, and are
+# left out of every diff
+_PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+_IGNORED_FILES = frozenset([tracemalloc.__file__] + [
+    os.path.join(_PACKAGE_DIR, name)
+    for name in ("tracer.py", "format.py", "writer.py", "__main__.py")])
+
 
 class MemoryTracer:
     """
@@ -29,7 +56,8 @@ class MemoryTracer:
                  sample_rate: float = 1.0,
                  max_stack_depth: int = 10,
                  track_gc: bool = True,
-                 max_events: int = 10000):
+                 max_events: int = 10000,
+                 compress: bool = False):
         """
         Initialize memory tracer.
         
@@ -39,22 +67,30 @@ class MemoryTracer:
             max_stack_depth: Maximum stack frames to capture
             track_gc: Whether to track garbage collection events
             max_events: Maximum events to keep in memory (ring buffer)
+            compress: Whether to zlib-compress the event stream
         """
         self.output_file = output_file
         self.sample_rate = sample_rate
         self.max_stack_depth = max_stack_depth
         self.track_gc = track_gc
         self.max_events = max_events
+        self.compress = compress
         
         self.format = TraceFormat()
         self.writer: Optional[TraceWriter] = None
         self.start_time: float = 0
-        self.last_event_time: float = 0
+        self.last_event_ns: int = 0  # perf_counter_ns() of the last event
         self.is_active = False
         
         # Sampling state
         self.allocation_count = 0
         self.sample_threshold = int(1.0 / sample_rate) if sample_rate < 1.0 else 1
+        # A snapshot costs O(traced blocks) whatever the rate; at low rates
+        # the next diff covers the skipped windows, which would have
+        # yielded few sampled sites anyway
+        self.snapshot_stride = (max(1, round(_LOW_SAMPLE_RATE / sample_rate))
+                                if sample_rate < _LOW_SAMPLE_RATE else 1)
+        self._snapshot_calls = 0
         
         # Statistics
         self.stats = {
@@ -64,9 +100,12 @@ class MemoryTracer:
             "gc_events": 0,
         }
         
-        # Previous snapshot for diff
-        self.prev_snapshot: Optional[tracemalloc.Snapshot] = None
+        # Bytes per allocation site at the previous snapshot, for diffing
+        self._prev_by_site: Optional[Dict[tracemalloc.Traceback, int]] = None
         
+        # GC events that arrived while this thread was encoding an event
+        self._pending_gc: Deque[int] = deque()
+    
     def start(self):
         """Start tracing."""
         global _active_tracer
@@ -78,18 +117,19 @@ class MemoryTracer:
         tracemalloc.start(self.max_stack_depth)
         
         # Initialize writer
-        self.writer = TraceWriter(self.output_file, max_queue_size=self.max_events)
+        self.writer = TraceWriter(self.output_file, max_queue_size=self.max_events,
+                                  compress=self.compress)
         
         # Record start time
         self.start_time = time.time()
-        self.last_event_time = self.start_time
+        self.last_event_ns = time.perf_counter_ns()
         
-        # Write header (will be updated with metadata on close)
-        header = self.format.create_header(self.start_time)
+        # Write header (metadata offset is patched in on close)
+        header = self.format.create_header(self.start_time, compressed=self.compress)
         self.writer.open(header)
         
         # Take initial snapshot
-        self.prev_snapshot = tracemalloc.take_snapshot()
+        self._prev_by_site = self._sizes_by_site(tracemalloc.take_snapshot())
         
         # Set up GC tracking
         if self.track_gc:
@@ -99,17 +139,20 @@ class MemoryTracer:
         _active_tracer = self
         
         # Professional startup message with ANSI colors
-        print("\n" + self._color("="*70, "cyan"))
-        print(self._color("  Memlyze v0.1.0", "cyan", bold=True) + self._color(" | Memory Profiler", "white"))
-        print(self._color("="*70, "cyan"))
-        print(self._color("  CONFIGURATION", "yellow", bold=True))
-        print(self._color("  ├─", "white") + " Output File    : " + self._color(self.output_file, "green"))
-        print(self._color("  ├─", "white") + " Sample Rate    : " + self._color(f"{self.sample_rate * 100:.1f}%", "green") + " of allocations")
-        print(self._color("  ├─", "white") + " Stack Depth    : " + self._color(f"{self.max_stack_depth}", "green") + " frames")
-        print(self._color("  └─", "white") + " GC Tracking    : " + self._color("ENABLED", "green" if self.track_gc else "red"))
-        print(self._color("="*70, "cyan"))
-        print(self._color("  STATUS", "yellow", bold=True) + " : " + self._color("TRACING ACTIVE", "green", bold=True))
-        print(self._color("="*70, "cyan") + "\n")
+        gc_color = _GREEN if self.track_gc else _RED
+        print("\n".join((
+            "\n" + _RULE,
+            f"{_BOLD_CYAN}  Memlyze v0.1.0{_RESET}{_WHITE} | Memory Profiler{_RESET}",
+            _RULE,
+            f"{_BOLD_YELLOW}  CONFIGURATION{_RESET}",
+            f"{_BRANCH} Output File    : {_GREEN}{self.output_file}{_RESET}",
+            f"{_BRANCH} Sample Rate    : {_GREEN}{self.sample_rate * 100:.1f}%{_RESET} of allocations",
+            f"{_BRANCH} Stack Depth    : {_GREEN}{self.max_stack_depth}{_RESET} frames",
+            f"{_LAST} GC Tracking    : {gc_color}ENABLED{_RESET}",
+            _RULE,
+            f"{_BOLD_YELLOW}  STATUS{_RESET} : {_BOLD_GREEN}TRACING ACTIVE{_RESET}",
+            _RULE + "\n",
+        )))
     
     def stop(self):
         """Stop tracing and save trace file."""
@@ -122,117 +165,162 @@ class MemoryTracer:
         if self.track_gc and self._on_gc in gc.callbacks:
             gc.callbacks.remove(self._on_gc)
         
-        # Take final snapshot and process differences
-        current_snapshot = tracemalloc.take_snapshot()
-        self._process_snapshot_diff(self.prev_snapshot, current_snapshot)
-        
-        # Stop tracemalloc
-        tracemalloc.stop()
+        # Take final snapshot and process differences; if that fails the
+        # trace is still closed with its tables before the error propagates
+        try:
+            current_snapshot = tracemalloc.take_snapshot()
+            self._process_snapshot_diff(current_snapshot)
+        finally:
+            # Stop tracemalloc
+            tracemalloc.stop()
+            
+            # Close writer, appending the string and stack tables
+            if self.writer:
+                self.writer.close(self.format.encode_metadata(),
+                                  TraceFormat.METADATA_OFFSET_POS)
+            self.is_active = False
+            _active_tracer = None
         
-        # Close writer
         if self.writer:
-            self.writer.close()
             writer_stats = self.writer.get_stats()
             duration = time.time() - self.start_time
             
             # Professional summary with colors
-            print("\n" + self._color("="*70, "cyan"))
-            print(self._color("  TRACE COMPLETE", "green", bold=True))
-            print(self._color("="*70, "cyan"))
+            dropped = writer_stats['events_dropped']
+            seen = self.stats['allocations_seen']
+            lines = [
+                "\n" + _RULE,
+                f"{_BOLD_GREEN}  TRACE COMPLETE{_RESET}",
+                _RULE,
+            ]
             
             # File info section
-            print(self._color("\n  OUTPUT", "yellow", bold=True))
             file_size_kb = writer_stats['bytes_written'] / 1024
             file_size_mb = file_size_kb / 1024
             size_str = f"{file_size_mb:.2f} MB" if file_size_mb >= 1 else f"{file_size_kb:.2f} KB"
-            print(self._color("  ├─", "white") + " File           : " + self._color(self.output_file, "green"))
-            print(self._color("  └─", "white") + " Size           : " + self._color(f"{writer_stats['bytes_written']:,} bytes", "white") + f" ({size_str})")
+            lines += [
+                f"{_BOLD_YELLOW}\n  OUTPUT{_RESET}",
+                f"{_BRANCH} File           : {_GREEN}{self.output_file}{_RESET}",
+                f"{_LAST} Size           : {_WHITE}{writer_stats['bytes_written']:,} bytes{_RESET} ({size_str})",
+            ]
             
             # Statistics section
-            print(self._color("\n  MEMORY EVENTS", "yellow", bold=True))
-            print(self._color("  ├─", "white") + " Allocations    : " + self._color(f"{self.stats['allocations_seen']:>10,}", "white") + " seen, " + 
-                  self._color(f"{self.stats['allocations_tracked']:>10,}", "green") + " tracked")
-            print(self._color("  ├─", "white") + " Deallocations  : " + self._color(f"{self.stats['deallocations_tracked']:>10,}", "white"))
-            print(self._color("  └─", "white") + " GC Events      : " + self._color(f"{self.stats['gc_events']:>10,}", "white"))
+            lines += [
+                f"{_BOLD_YELLOW}\n  MEMORY EVENTS{_RESET}",
+                f"{_BRANCH} Allocations    : {_WHITE}{seen:>10,}{_RESET} seen, "
+                f"{_GREEN}{self.stats['allocations_tracked']:>10,}{_RESET} tracked",
+                f"{_BRANCH} Deallocations  : {_WHITE}{self.stats['deallocations_tracked']:>10,}{_RESET}",
+                f"{_LAST} GC Events      : {_WHITE}{self.stats['gc_events']:>10,}{_RESET}",
+            ]
             
             # Performance section
-            print(self._color("\n  PERFORMANCE", "yellow", bold=True))
-            print(self._color("  ├─", "white") + " Events Written : " + self._color(f"{writer_stats['events_written']:>10,}", "white"))
-            print(self._color("  ├─", "white") + " Events Dropped : " + self._color(f"{writer_stats['events_dropped']:>10,}", "red" if writer_stats['events_dropped'] > 0 else "white"))
-            print(self._color("  ├─", "white") + " Duration       : " + self._color(f"{duration:>10.2f}s", "white"))
+            lines += [
+                f"{_BOLD_YELLOW}\n  PERFORMANCE{_RESET}",
+                f"{_BRANCH} Events Written : {_WHITE}{writer_stats['events_written']:>10,}{_RESET}",
+                f"{_BRANCH} Events Dropped : {_RED if dropped > 0 else _WHITE}{dropped:>10,}{_RESET}",
+                f"{_BRANCH} Duration       : {_WHITE}{duration:>10.2f}s{_RESET}",
+            ]
             
             # Calculate overhead estimate
-            if self.stats['allocations_seen'] > 0:
-                alloc_rate = self.stats['allocations_seen'] / duration
-                print(self._color("  └─", "white") + " Alloc Rate     : " + self._color(f"{alloc_rate:>10,.0f}", "white") + " allocs/sec")
+            if seen > 0:
+                alloc_rate = seen / duration
+                lines.append(f"{_LAST} Alloc Rate     : {_WHITE}{alloc_rate:>10,.0f}{_RESET} allocs/sec")
             
             # Sampling efficiency
-            if self.stats['allocations_seen'] > 0:
-                sample_pct = (self.stats['allocations_tracked'] / self.stats['allocations_seen']) * 100
-                print(self._color("\n  SAMPLING", "yellow", bold=True))
-                print(self._color("  └─", "white") + " Efficiency     : " + self._color(f"{sample_pct:>10.1f}%", "green") + " captured")
+            if seen > 0:
+                sample_pct = (self.stats['allocations_tracked'] / seen) * 100
+                lines += [
+                    f"{_BOLD_YELLOW}\n  SAMPLING{_RESET}",
+                    f"{_LAST} Efficiency     : {_GREEN}{sample_pct:>10.1f}%{_RESET} captured",
+                ]
             
             # Warnings section
-            if writer_stats['events_dropped'] > 0:
-                print(self._color("\n  WARNINGS", "red", bold=True))
-                print(self._color("  └─", "white") + " Ring buffer full: " + self._color(f"{writer_stats['events_dropped']:,} events dropped", "red"))
-                print(self._color("     Recommendation: Increase --sample-rate or buffer size", "yellow"))
+            if dropped > 0:
+                lines += [
+                    f"{_BOLD_RED}\n  WARNINGS{_RESET}",
+                    f"{_LAST} Ring buffer full: {_RED}{dropped:,} events dropped{_RESET}",
+                    f"{_YELLOW}     Recommendation: Increase --sample-rate or buffer size{_RESET}",
+                ]
             
-            print(self._color("="*70, "cyan"))
-            print(self._color("  NEXT STEPS", "yellow", bold=True))
-            print(self._color("  └─", "white") + " Analyze results : " + 
-                  self._color(f"memlyze analyze {os.path.basename(self.output_file)}", "green"))
-            print(self._color("     Web interface : ", "white") + 
-                  self._color(f"memlyze serve {os.path.basename(self.output_file)}", "green"))
-            print(self._color("     Help          : ", "white") + 
-                  self._color("memlyze --help", "green"))
-            print(self._color("="*70, "cyan") + "\n")
-        
-        self.is_active = False
-        _active_tracer = None
+            trace_name = os.path.basename(self.output_file)
+            lines += [
+                _RULE,
+                f"{_BOLD_YELLOW}  NEXT STEPS{_RESET}",
+                f"{_LAST} Analyze results : {_GREEN}memlyze analyze {trace_name}{_RESET}",
+                f"{_WHITE}     Web interface : {_RESET}{_GREEN}memlyze serve {trace_name}{_RESET}",
+                f"{_WHITE}     Help          : {_RESET}{_GREEN}memlyze --help{_RESET}",
+                _RULE + "\n",
+            ]
+            print("\n".join(lines))
+    
+    @staticmethod
+    def _sizes_by_site(snapshot: tracemalloc.Snapshot) -> Dict[tracemalloc.Traceback, int]:
+        """Total traced bytes per allocation site (file and line), excluding the tracer."""
+        # Filtering the grouped sites is O(sites); Snapshot.filter_traces()
+        # would match every raw trace in Python, costing more than the grouping
+        ignored = _IGNORED_FILES
+        return {stat.traceback: stat.size for stat in snapshot.statistics('lineno')
+                if stat.traceback[0].filename not in ignored}
     
-    def _process_snapshot_diff(self, prev: Optional[tracemalloc.Snapshot], current: tracemalloc.Snapshot):
-        """Process differences between snapshots to find allocations/deallocations."""
-        if prev is None:
+    def _process_snapshot_diff(self, current: tracemalloc.Snapshot):
+        """Process differences from the previous snapshot to find allocations/deallocations."""
+        prev_by_site = self._prev_by_site
+        if prev_by_site is None:
             return
         
-        # Get differences
-        top_stats = current.compare_to(prev, 'lineno')
-        
-        current_time = time.time()
-        timestamp_delta = int((current_time - self.last_event_time) * 1_000_000)
-        
-        for stat in top_stats:
-            self.stats['allocations_seen'] += 1
-            
-            # Apply sampling
-            if self.sample_rate < 1.0:
-                self.allocation_count += 1
-                if self.allocation_count % self.sample_threshold != 0:
-                    continue
-            
-            if stat.size_diff > 0:
+        # Diff per-site sizes with dict lookups rather than compare_to(),
+        # which builds and sorts a StatisticDiff for every site. Sites that
+        # disappeared since the previous snapshot were freed entirely.
+        current_by_site = self._sizes_by_site(current)
+        freed = [(site, -size)
+                 for site, size in prev_by_site.items() if site not in current_by_site]
+        diffs = itertools.chain(
+            ((site, size - prev_by_site.get(site, 0))
+             for site, size in current_by_site.items()),
+            freed)
+        self._prev_by_site = current_by_site
+        
+        seen = len(current_by_site) + len(freed)
+        self.stats['allocations_seen'] += seen
+        
+        # Apply sampling up front: keep every sample_threshold-th site,
+        # continuing the count from earlier snapshots
+        if self.sample_rate < 1.0:
+            step = self.sample_threshold
+            first = -(self.allocation_count + 1) % step
+            self.allocation_count += seen
+            diffs = itertools.islice(diffs, first, None, step)
+        
+        # Another thread (mark(), a GC callback) may have moved last_event_ns
+        # past our reading of the clock; deltas are unsigned varints
+        now = time.perf_counter_ns()
+        timestamp_delta = max(0, (now - self.last_event_ns) // 1000)
+        
+        for site, size_diff in diffs:
+            if size_diff > 0:
                 # Allocation
                 self._record_allocation(
                     timestamp_delta,
-                    stat.size_diff,
-                    stat.traceback
+                    size_diff,
+                    site
                 )
-            elif stat.size_diff < 0:
+            elif size_diff < 0:
                 # Deallocation
-                self._record_deallocation(timestamp_delta, abs(stat.size_diff))
+                self._record_deallocation(timestamp_delta, -size_diff)
         
-        self.last_event_time = current_time
+        self.last_event_ns = now
+        self._flush_pending_gc()
     
     def _record_allocation(self, timestamp_delta: int, size: int, traceback: tracemalloc.Traceback):
         """Record an allocation event."""
         if not self.writer:
             return
         
-        # Extract stack trace
-        stack_trace = []
-        for frame in traceback:
-            stack_trace.append((frame.filename, frame.lineno, ""))
+        # Extract stack trace as a tuple, which doubles as the cache key;
+        # interned filenames make the key's equality checks pointer compares
+        intern = sys.intern
+        stack_trace = tuple((intern(frame.filename), frame.lineno, "")
+                            for frame in traceback)
         
         # Get stack ID
         stack_id = self.format.get_or_create_stack_id(stack_trace)
@@ -240,17 +328,17 @@ class MemoryTracer:
         # Get thread ID
         thread_id = threading.get_ident() & 0xFFFF  # Truncate to uint16
         
-        # Encode event
-        event_data = self.format.encode_alloc_event(
+        # Encode event straight into this thread's write slot; ALLOC_V2
+        # omits the address, which tracemalloc does not provide
+        slot, pos = self.writer.event_slot()
+        self.writer.commit_event(self.format.encode_alloc_v2_event_into(
+            slot,
+            pos,
             timestamp_delta,
-            0,  # Address not available from tracemalloc
             size,
             stack_id,
             thread_id
-        )
-        
-        # Write event
-        self.writer.write_event(event_data)
+        ))
         self.stats['allocations_tracked'] += 1
     
     def _record_deallocation(self, timestamp_delta: int, size: int):
@@ -259,10 +347,8 @@ class MemoryTracer:
             return
         
         # Encode event (address 0 since we don't have it)
-        event_data = self.format.encode_free_event(timestamp_delta, 0)
-        
-        # Write event
-        self.writer.write_event(event_data)
+        slot, pos = self.writer.event_slot()
+        self.writer.commit_event(self.format.encode_free_event_into(slot, pos, timestamp_delta, 0))
         self.stats['deallocations_tracked'] += 1
     
     def _on_gc(self, phase: str, info: dict):
@@ -273,75 +359,80 @@ class MemoryTracer:
         if not self.writer:
             return
         
-        current_time = time.time()
-        timestamp_delta = int((current_time - self.last_event_time) * 1_000_000)
+        # A collection can run inside an encode on this thread (the encode
+        # allocated); writing now would land on the uncommitted event, so
+        # hold the GC event until that slot is committed
+        collected = info.get('collected', 0)
+        if self.writer.event_in_progress():
+            self._pending_gc.append(collected)
+            return
         
-        # Encode GC event
-        event_data = self.format.encode_gc_event(
+        self._flush_pending_gc()
+        self._write_gc_event(collected)
+    
+    def _flush_pending_gc(self):
+        """Write GC events held back by _on_gc()."""
+        while self._pending_gc:
+            try:
+                collected = self._pending_gc.popleft()
+            except IndexError:
+                break
+            self._write_gc_event(collected)
+    
+    def _write_gc_event(self, collected: int):
+        """Encode one GC event."""
+        now = time.perf_counter_ns()
+        timestamp_delta = max(0, (now - self.last_event_ns) // 1000)
+        
+        slot, pos = self.writer.event_slot()
+        self.writer.commit_event(self.format.encode_gc_event_into(
+            slot,
+            pos,
             timestamp_delta,
-            info.get('collected', 0),
+            collected,
             0  # Bytes freed not available
-        )
-        
-        # Write event
-        self.writer.write_event(event_data)
+        ))
         self.stats['gc_events'] += 1
-        self.last_event_time = current_time
+        self.last_event_ns = now
     
     def mark(self, name: str):
         """Add a marker/annotation to the trace."""
         if not self.writer or not self.is_active:
             return
         
-        current_time = time.time()
-        timestamp_delta = int((current_time - self.last_event_time) * 1_000_000)
+        now = time.perf_counter_ns()
+        timestamp_delta = max(0, (now - self.last_event_ns) // 1000)
         
-        event_data = self.format.encode_marker_event(timestamp_delta, name)
-        self.writer.write_event(event_data)
-        self.last_event_time = current_time
+        slot, pos = self.writer.event_slot()
+        self.writer.commit_event(self.format.encode_marker_event_into(slot, pos, timestamp_delta, name))
+        self.last_event_ns = now
+        self._flush_pending_gc()
     
     def snapshot(self):
-        """Take a snapshot and process allocations since last snapshot."""
+        """
+        Take a snapshot and process allocations since last snapshot.
+        
+        Below a 1% sample rate only every snapshot_stride-th call takes
+        one; the others return at once. stop() always takes the final one.
+        """
         if not self.is_active:
             return
         
-        current_snapshot = tracemalloc.take_snapshot()
-        self._process_snapshot_diff(self.prev_snapshot, current_snapshot)
-        self.prev_snapshot = current_snapshot
-    
-    @staticmethod
-    def _color(text, color, bold=False, dim=False):
-        """Apply ANSI color codes to text."""
-        colors = {
-            "black": "30",
-            "red": "31",
-            "green": "32",
-            "yellow": "33",
-            "blue": "34",
-            "magenta": "35",
-            "cyan": "36",
-            "white": "37",
-        }
+        if self.snapshot_stride > 1:
+            self._snapshot_calls += 1
+            if self._snapshot_calls % self.snapshot_stride:
+                return
         
-        code = colors.get(color, "37")
-        style = []
-        
-        if bold:
-            style.append("1")
-        if dim:
-            style.append("2")
-        
-        if style:
-            return f"\033[{';'.join(style)};{code}m{text}\033[0m"
-        else:
-            return f"\033[{code}m{text}\033[0m"
+        current_snapshot = tracemalloc.take_snapshot()
+        self._process_snapshot_diff(current_snapshot)
 
 
 # Convenience functions
 def start(output_file: str = "trace.mlyze",
           sample_rate: float = 1.0,
           max_stack_depth: int = 10,
-          track_gc: bool = True) -> MemoryTracer:
+          track_gc: bool = True,
+          compress: bool = False) -> MemoryTracer:
     """
     Start memory tracing.
     
@@ -350,6 +441,7 @@ def start(output_file: str = "trace.mlyze",
         sample_rate: Fraction of allocations to track (1.0 = all, 0.1 = 10%)
         max_stack_depth: Maximum stack frames to capture
         track_gc: Whether to track garbage collection events
+        compress: Whether to zlib-compress the event stream
         
     Returns:
         MemoryTracer instance
@@ -358,7 +450,8 @@ def start(output_file: str = "trace.mlyze",
         output_file=output_file,
         sample_rate=sample_rate,
         max_stack_depth=max_stack_depth,
-        track_gc=track_gc
+        track_gc=track_gc,
+        compress=compress
     )
     tracer.start()
     return tracer
@@ -2,11 +2,55 @@
 Efficient trace file writer with batching and compression.
 """
 
-import io
+import os
+import struct
 import threading
-from typing import Optional
+import zlib
+from typing import Optional, Deque, List, Tuple
 from collections import deque
-import time
+
+
+# Buffers per writev() call; POSIX guarantees at least 16, Linux allows 1024
+_IOV_MAX = 1024
+_O_BINARY = getattr(os, "O_BINARY", 0)  # Windows only
+_U64 = struct.Struct('<Q')
+_SLOT_SLACK = 64  # Room past buffer_size for one encoded event
+_FIRST_SLOT_SIZE = 1024  # A thread's first slot, grown to buffer_size once it fills
+
+
+def _write_all(fd: int, chunks: List[bytearray]):
+    """Write chunks to fd in order, gathering them into as few syscalls as possible."""
+    if not hasattr(os, "writev"):
+        # Windows has no writev; join once and loop over short writes
+        view = memoryview(b"".join(chunks))
+        while view:
+            view = view[os.write(fd, view):]
+        return
+    
+    chunks = list(chunks)
+    i = 0
+    while i < len(chunks):
+        written = os.writev(fd, chunks[i:i + _IOV_MAX])
+        # Skip whole chunks that made it out, then trim a partially written one
+        while i < len(chunks) and written >= len(chunks[i]):
+            written -= len(chunks[i])
+            i += 1
+        if written:
+            chunks[i] = memoryview(chunks[i])[written:]
+
+
+class _ThreadBuffer:
+    """Events encoded by one thread that have not been handed off yet."""
+    
+    __slots__ = ("data", "length", "events", "busy", "limit", "owner")
+    
+    def __init__(self, data: bytearray, limit: int):
+        self.data = data  # Slot, filled up to length
+        self.length = 0
+        self.events = 0
+        self.busy = False  # Between event_slot() and commit_event()
+        self.limit = limit  # Hand off once length reaches this; 0 asks for a flush
+        self.owner = threading.current_thread()
 
 
 class TraceWriter:
@@ -14,31 +58,46 @@ class TraceWriter:
     Writes trace events to disk efficiently.
     
     Features:
-    - Batched writes (don't flush on every event)
+    - Per-thread buffers (no lock taken per event), flushed when they
+      fill, sit idle or their thread exits
+    - Small first slot per thread, grown to a full slot once it fills
+    - Full slots recycled once written
     - Background thread for async I/O
-    - Ring buffer to prevent memory explosion
+    - Bounded hand-off queue to prevent memory explosion
+    - Optional zlib compression of the event stream
     """
     
     def __init__(self, 
                  filepath: str,
-                 buffer_size: int = 64 * 1024,  # 64KB buffer
-                 max_queue_size: int = 10000):
+                 buffer_size: int = 16 * 1024,  # 16KB per thread
+                 max_queue_size: int = 10000,
+                 compress: bool = False):
         """
         Initialize trace writer.
         
         Args:
             filepath: Path to output .mtrace file
-            buffer_size: Size of write buffer in bytes
-            max_queue_size: Maximum events in queue (ring buffer)
+            buffer_size: Bytes a thread buffers before handing them to the writer
+            max_queue_size: Maximum events waiting to be written
+            compress: Compress events as one zlib stream (header and
+                trailer stay uncompressed)
         """
         self.filepath = filepath
         self.buffer_size = buffer_size
         self.max_queue_size = max_queue_size
+        # Level 1: event streams compress well even at the fastest level
+        self._compressor = zlib.compressobj(1) if compress else None
         
-        self.file: Optional[io.BufferedWriter] = None
-        self.buffer = bytearray()
-        self.queue: deque = deque(maxlen=max_queue_size)
+        self._fd: Optional[int] = None  # Raw fd, no BufferedWriter copy in between
+        self._local = threading.local()
+        self._thread_buffers: List[_ThreadBuffer] = []  # Every thread's buffer, for close()
+        self._full_buffers: Deque[Tuple[bytearray, int, int]] = deque()  # (data, length, event count)
+        self._slot_size = buffer_size + _SLOT_SLACK
+        self._first_size = min(_FIRST_SLOT_SIZE, buffer_size)
+        self._free_slots: List[bytearray] = []  # Written slots, ready for reuse
+        self._queued_events = 0
         self.lock = threading.Lock()
+        self._cv = threading.Condition(self.lock)  # Signalled on hand-off and close
         self.writer_thread: Optional[threading.Thread] = None
         self.should_stop = threading.Event()
         self.events_written = 0
@@ -47,8 +106,12 @@ class TraceWriter:
         
     def open(self, header: bytes):
         """Open file and write header."""
-        self.file = open(self.filepath, 'wb')
-        self.file.write(header)
+        # O_APPEND: the kernel places every write at the end of the file,
+        # so no file position is maintained between batches
+        self._fd = os.open(self.filepath,
+                           os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND | _O_BINARY,
+                           0o644)
+        _write_all(self._fd, [header])
         self.bytes_written += len(header)
         
         # Start background writer thread
@@ -63,66 +126,244 @@ class TraceWriter:
         Args:
             event_data: Encoded event bytes
         """
+        # Copy into this thread's slot without locking; the lock is only
+        # taken once per buffer_size bytes, when the slot is handed off
+        buf = self._thread_buffer()
+        end = buf.length + len(event_data)
+        if end > len(buf.data):
+            with self.lock:
+                self._hand_off(buf)
+                if buf.length + len(event_data) > len(buf.data):
+                    self._hand_off(buf)  # Grown from the first slot, events still in it
+                if len(event_data) > len(buf.data):
+                    # Too big for the slot: queue it on its own
+                    self._enqueue(bytearray(event_data), len(event_data), 1)
+                    return
+            end = buf.length + len(event_data)
+        buf.data[buf.length:end] = event_data
+        buf.length = end
+        buf.events += 1
+        if end >= buf.limit:
+            with self.lock:
+                self._hand_off(buf)
+    
+    def event_slot(self) -> Tuple[bytearray, int]:
+        """
+        Return this thread's slot and write offset, to encode an event in place.
+        
+        At least 64 bytes are free at the offset. Pass the end of the
+        encoded event to commit_event(). The slot is swapped out when it
+        is handed off, so fetch it again for every event. The pair is not
+        reentrant: code that can run in the middle of an encode (a GC
+        callback) must check event_in_progress() first.
+        """
+        try:
+            buf = self._local.buffer
+        except AttributeError:
+            buf = self._thread_buffer()
+        buf.busy = True
+        return buf.data, buf.length
+    
+    def commit_event(self, end: int):
+        """Count an event encoded via event_slot(), handing off a full slot."""
+        buf = self._local.buffer
+        buf.length = end
+        buf.events += 1
+        buf.busy = False
+        if end >= buf.limit:
+            with self.lock:
+                self._hand_off(buf)
+    
+    def event_in_progress(self) -> bool:
+        """Whether the calling thread holds a slot from event_slot() it has not committed."""
+        try:
+            return self._local.buffer.busy
+        except AttributeError:
+            return False
+    
+    def _thread_buffer(self) -> _ThreadBuffer:
+        """Get the calling thread's buffer, registering it on first use."""
+        try:
+            return self._local.buffer
+        except AttributeError:
+            with self.lock:
+                # Most threads record a few events; only the ones that
+                # fill this get a full slot
+                buf = self._local.buffer = _ThreadBuffer(
+                    bytearray(self._first_size + _SLOT_SLACK), self._first_size)
+                self._thread_buffers.append(buf)
+            return buf
+    
+    def _new_slot(self) -> bytearray:
+        """Reuse a written slot, or allocate one. Caller holds the lock."""
+        if self._free_slots:
+            return self._free_slots.pop()
+        return bytearray(self._slot_size)
+    
+    def _hand_off(self, buf: _ThreadBuffer):
+        """Move a thread buffer onto the write queue. Caller holds the lock."""
+        first = len(buf.data) < self._slot_size
+        buf.limit = self._first_size if first else self.buffer_size
+        if not buf.events:
+            return
+        
+        if first and buf.length >= self._first_size:
+            # Filled its first slot: move the events to a full slot
+            data = self._new_slot()
+            data[:buf.length] = memoryview(buf.data)[:buf.length]
+            buf.data = data
+            buf.limit = self.buffer_size
+            return
+        
+        self._enqueue(buf.data, buf.length, buf.events)
+        buf.data = bytearray(self._first_size + _SLOT_SLACK) if first else self._new_slot()
+        buf.length = 0
+        buf.events = 0
+    
+    def _enqueue(self, data: bytearray, length: int, events: int):
+        """Queue filled bytes for the writer thread. Caller holds the lock."""
+        self._full_buffers.append((data, length, events))
+        self._queued_events += events
+        
+        # Queue is full, drop oldest buffers (keep at least the newest)
+        while self._queued_events > self.max_queue_size and len(self._full_buffers) > 1:
+            data, _, dropped = self._full_buffers.popleft()
+            self._queued_events -= dropped
+            self.events_dropped += dropped
+            self._recycle(data)
+        
+        self._cv.notify()
+    
+    def _recycle(self, data: bytearray):
+        """Return a slot to the free list. Caller holds the lock."""
+        # A hand-off needs one spare slot per live thread at most
+        if len(data) == self._slot_size and len(self._free_slots) < len(self._thread_buffers):
+            self._free_slots.append(data)
+    
+    def _sweep_thread_buffers(self):
+        """
+        Flush buffers that would otherwise wait for close(). Caller holds the lock.
+        
+        A buffer whose thread has exited is queued (or its slot recycled)
+        and forgotten. A live thread's partial buffer is asked to flush:
+        the owner hands it off on its next commit, since only the owner
+        may swap the slot it writes into without a lock.
+        """
+        live = []
+        for buf in self._thread_buffers:
+            if buf.owner.is_alive():
+                if buf.events:
+                    buf.limit = 0
+                live.append(buf)
+            elif buf.events:
+                self._enqueue(buf.data, buf.length, buf.events)
+            else:
+                self._recycle(buf.data)
+        self._thread_buffers[:] = live
+    
+    def _take_buffers(self) -> List[Tuple[bytearray, int, int]]:
+        """Remove and return all queued buffers."""
         with self.lock:
-            if len(self.queue) >= self.max_queue_size:
-                # Ring buffer is full, drop oldest event
-                self.queue.popleft()
-                self.events_dropped += 1
-            
-            self.queue.append(event_data)
+            buffers = list(self._full_buffers)
+            self._full_buffers.clear()
+            self._queued_events = 0
+        return buffers
     
     def _writer_loop(self):
         """Background thread that flushes events to disk."""
         while not self.should_stop.is_set():
-            # Get events from queue
-            events_to_write = []
-            with self.lock:
-                while self.queue and len(events_to_write) < 1000:  # Batch up to 1000 events
-                    events_to_write.append(self.queue.popleft())
+            with self._cv:
+                # Block until a buffer is handed off or close() is called;
+                # an idle wait is the time to collect partial buffers
+                if not self._full_buffers and not self.should_stop.is_set():
+                    if not self._cv.wait(timeout=0.05):
+                        self._sweep_thread_buffers()
             
-            if events_to_write:
-                # Write batch
-                for event_data in events_to_write:
-                    self.buffer.extend(event_data)
-                    self.events_written += 1
-                    
-                    # Flush if buffer is full
-                    if len(self.buffer) >= self.buffer_size:
-                        self._flush_buffer()
-            else:
-                # No events, sleep briefly
-                time.sleep(0.001)  # 1ms
-    
-    def _flush_buffer(self):
-        """Flush buffer to disk."""
-        if self.file and self.buffer:
-            self.file.write(self.buffer)
-            self.bytes_written += len(self.buffer)
-            self.buffer.clear()
-    
-    def close(self):
-        """Close file and stop background thread."""
+            buffers = self._take_buffers()
+            if buffers:
+                self._write_buffers(buffers)
+    
+    def _write_buffers(self, buffers: List[Tuple[bytearray, int, int]]):
+        """Write the filled part of each buffer in one gathered write, then recycle them."""
+        if self._fd is None or not buffers:
+            return
+        chunks = [memoryview(data)[:length] for data, length, _ in buffers]
+        if self._compressor is not None:
+            compress = self._compressor.compress
+            chunks = [compress(chunk) for chunk in chunks]
+        _write_all(self._fd, chunks)
+        for chunk in chunks:
+            self.bytes_written += len(chunk)
+        for _, _, events in buffers:
+            self.events_written += events
+        
+        chunks = None  # Release the views before the slots are reused
+        with self.lock:
+            for data, _, _ in buffers:
+                self._recycle(data)
+    
+    def close(self, trailer: bytes = b"", offset_pos: Optional[int] = None):
+        """
+        Close file and stop background thread.
+        
+        Args:
+            trailer: Bytes to append after the last event
+            offset_pos: Header position to patch with the trailer's file
+                offset (uint64), if any
+        """
         # Signal thread to stop
         self.should_stop.set()
+        with self._cv:
+            self._cv.notify_all()
         
         # Wait for thread to finish
         if self.writer_thread:
             self.writer_thread.join(timeout=5.0)
         
-        # Flush any remaining events
+        # Final flush: the queue, then what every thread still has buffered.
+        # The writer thread is done, so nothing here is subject to the
+        # drop-oldest queue limit
+        buffers = self._take_buffers()
         with self.lock:
-            while self.queue:
-                event_data = self.queue.popleft()
-                self.buffer.extend(event_data)
-                self.events_written += 1
-        
-        # Final flush
-        self._flush_buffer()
+            for buf in self._thread_buffers:
+                if buf.events:
+                    buffers.append((buf.data, buf.length, buf.events))
+                    buf.data = bytearray(self._first_size + _SLOT_SLACK)
+                    buf.limit = self._first_size
+                    buf.length = 0
+                    buf.events = 0
+        self._write_buffers(buffers)
         
-        # Close file
-        if self.file:
-            self.file.close()
-            self.file = None
+        if self._fd is not None:
+            # End the compressed stream before the uncompressed trailer
+            if self._compressor is not None:
+                tail = self._compressor.flush()
+                _write_all(self._fd, [tail])
+                self.bytes_written += len(tail)
+                self._compressor = None
+            
+            # Append the trailer and record where it starts
+            if trailer:
+                trailer_offset = self.bytes_written
+                _write_all(self._fd, [trailer])
+                self.bytes_written += len(trailer)
+                if offset_pos is not None:
+                    self._patch(offset_pos, _U64.pack(trailer_offset))
+            
+            # Close file
+            os.close(self._fd)
+            self._fd = None
+    
+    def _patch(self, offset: int, data: bytes):
+        """Overwrite bytes already written, e.g. a header field."""
+        # Writes through the O_APPEND descriptor always land at the end
+        # (even pwrite on Linux), so patch through a second descriptor
+        fd = os.open(self.filepath, os.O_WRONLY | _O_BINARY)
+        try:
+            os.lseek(fd, offset, os.SEEK_SET)
+            _write_all(fd, [data])
+        finally:
+            os.close(fd)
     
     def get_stats(self) -> dict:
         """Get writer statistics."""
@@ -130,5 +371,5 @@ class TraceWriter:
             "events_written": self.events_written,
             "events_dropped": self.events_dropped,
             "bytes_written": self.bytes_written,
-            "queue_size": len(self.queue),
+            "queue_size": self._queued_events,
         }
@@ -1,47 +1,51 @@
 """
 Setup script for memtrace Python package.
+
+Supplies the long description declared dynamic in pyproject.toml.
 """
 
-from setuptools import setup, find_packages
+import functools
+import io
+import mmap
 import os
+from pathlib import Path
+
 
+# Files above this size are decoded straight from an mmap; below it the
+# mapping setup costs more than the copy it saves
+_MMAP_THRESHOLD = 64 * 1024
 
-# Read README
+
+# Read README (cached, so repeated calls in one run reuse the text)
+@functools.lru_cache(maxsize=8)
 def read_file(filename):
-    with open(os.path.join(os.path.dirname(__file__), filename), encoding='utf-8') as f:
-        return f.read()
-
-
-setup(
-    name="memlyze",
-    version="0.1.0",
-    author="Memlyze Team",
-    description="Visual memory profiler with <5% overhead",
-    long_description=read_file("../README.md") if os.path.exists("../README.md") else "",
-    long_description_content_type="text/markdown",
-    url="https://github.com/rarfile/memlyze",
-    packages=find_packages(),
-    classifiers=[
-        "Development Status :: 3 - Alpha",
-        "Intended Audience :: Developers",
-        "Topic :: Software Development :: Debuggers",
-        "License :: OSI Approved :: MIT License",
-        "Programming Language :: Python :: 3",
-        "Programming Language :: Python :: 3.8",
-        "Programming Language :: Python :: 3.9",
-        "Programming Language :: Python :: 3.10",
-        "Programming Language :: Python :: 3.11",
-        "Programming Language :: Python :: 3.12",
-    ],
-    python_requires=">=3.8",
-    install_requires=[
-        # No external dependencies for Phase 1!
-    ],
-    entry_points={
-        "console_scripts": [
-            "memlyze=memlyze.__main__:main",
-        ],
-    },
-    include_package_data=True,
-    zip_safe=False,
-)
+    with (Path(__file__).parent / filename).open('rb') as f:
+        if os.fstat(f.fileno()).st_size <= _MMAP_THRESHOLD:
+            text = f.read().decode('utf-8')
+        else:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                text = str(mm, 'utf-8')
+    # Same newline translation as a text-mode read. Done through StringIO:
+    # setuptools.build_meta rewrites CR-LF escape sequences in this file's
+    # source before running it, which would break a str.replace() here
+    return io.StringIO(text, newline=None).read()
+
+
+# Always read: PEP 517 frontends build metadata through dist_info/egg_info
+# and editable_wheel as well as bdist_wheel, and the README is one small file
+def long_description():
+    try:
+        return read_file("../README.md")
+    except FileNotFoundError:
+        return ""
+
+
+# Static metadata lives in pyproject.toml; only the README is left here.
+# setuptools is imported only when the script runs, not when tools import it
+if __name__ == "__main__":
+    from setuptools import setup
+    
+    setup(
+        long_description=long_description(),
+        long_description_content_type="text/markdown",
+    )
@@ -0,0 +1,48 @@
+"""
+Tests for the memlyze command line.
+"""
+
+import os
+import struct
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import memlyze
+from memlyze._parse import parse_events
+from memlyze.format import TraceFormat
+
+
+SCRIPT = "data = [bytearray(1000) for _ in range(100)]\n"
+
+
+class RecordTest(unittest.TestCase):
+
+    def test_only_script_frames_traced(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            script = os.path.join(tmp, "app.py")
+            with open(script, "w") as f:
+                f.write(SCRIPT)
+            trace = os.path.join(tmp, "app.mlyze")
+            env = dict(os.environ,
+                       PYTHONPATH=os.path.dirname(os.path.dirname(memlyze.__file__)))
+            subprocess.run([sys.executable, "-m", "memlyze", "record", "-o", trace,
+                            "python", script],
+                           cwd=tmp, env=env, check=True, stdout=subprocess.DEVNULL)
+            
+            with open(trace, 'rb') as f:
+                data = f.read()
+            metadata, events_offset = TraceFormat.parse_header(data)
+            (metadata_offset,) = struct.unpack_from('<Q', data, TraceFormat.METADATA_OFFSET_POS)
+            summary = parse_events(data, events_offset, limit=metadata_offset - events_offset)
+            self.assertGreater(summary["alloc_count"], 0)
+            
+            files = {metadata["files"][file_id]
+                     for stack in metadata["stack_traces"] for file_id, _, _ in stack}
+            # Nothing from the machinery that runs the script
+            self.assertEqual(files, {os.path.abspath(script)})
+
+
+if __name__ == "__main__":
+    unittest.main()
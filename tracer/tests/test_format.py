@@ -0,0 +1,227 @@
+"""
+Tests for the trace format encoders.
+"""
+
+import io
+import json
+import os
+import struct
+import tempfile
+import threading
+import time
+import unittest
+
+from memlyze._parse import InflateReader, parse_events
+from memlyze.format import EventType, TraceFormat
+from memlyze.writer import TraceWriter
+
+
+STACK = (("app.py", 10, "main"), ("lib.py", 3, "helper"))
+
+
+class VarintTest(unittest.TestCase):
+
+    def test_negative_values_rejected(self):
+        fmt = TraceFormat()
+        out = bytearray(64)
+        for value in (-1, -128, -129, -2**40):
+            with self.assertRaises(ValueError):
+                fmt.encode_varint(value)
+            with self.assertRaises(ValueError):
+                fmt.encode_marker_event_into(out, 0, value, "m")
+            with self.assertRaises(ValueError):
+                fmt.encode_alloc_v2_event_into(out, 0, value, 16, 0, 0)
+    
+    def test_into_matches_bytes(self):
+        fmt = TraceFormat()
+        out = bytearray(64)
+        for value in (0, 1, 127, 128, 16383, 16384, 2**32, 2**63):
+            end = fmt.encode_gc_event_into(out, 0, value, value, value)
+            self.assertEqual(bytes(out[:end]), fmt.encode_gc_event(value, value, value))
+            end = fmt.encode_alloc_v2_event_into(out, 0, value, value, 1, 2)
+            self.assertEqual(bytes(out[:end]), fmt.encode_alloc_v2_event(value, value, 1, 2))
+
+
+class TraceRoundTripTest(unittest.TestCase):
+    """Encode a trace through TraceWriter and read it back."""
+    
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self._tmp.name, "t.mlyze")
+    
+    def tearDown(self):
+        self._tmp.cleanup()
+    
+    def _write(self, close_tables=True, compress=False):
+        fmt = TraceFormat()
+        writer = TraceWriter(self.path, compress=compress)
+        writer.open(fmt.create_header(1.5, compressed=compress))
+        stack_id = fmt.get_or_create_stack_id(STACK)
+        writer.write_event(fmt.encode_alloc_v2_event(5, 64, stack_id, 1))
+        writer.write_event(fmt.encode_alloc_event(1, 0x1000, 32, stack_id, 1))
+        writer.write_event(fmt.encode_free_event(1, 0x1000))
+        writer.write_event(fmt.encode_gc_event(2, 7, 0))
+        writer.write_event(fmt.encode_marker_event(3, "phase"))
+        if close_tables:
+            writer.close(fmt.encode_metadata(), TraceFormat.METADATA_OFFSET_POS)
+        else:
+            writer.close()  # Like a trace whose tables never got written
+        with open(self.path, 'rb') as f:
+            return f.read()
+    
+    def _check_events(self, summary):
+        self.assertEqual(summary["event_count"], 5)
+        self.assertEqual(summary["alloc_count"], 2)
+        self.assertEqual(summary["free_count"], 1)
+        self.assertEqual(summary["gc_count"], 1)
+        self.assertEqual(summary["marker_count"], 1)
+        self.assertEqual(summary["total_allocated"], 96)
+        self.assertEqual(summary["total_freed"], 32)
+        self.assertEqual(summary["end_time"], 1_500_000 + 12)
+    
+    def _check_tables(self, metadata):
+        self.assertEqual(metadata["files"], ["app.py", "lib.py"])
+        self.assertEqual(metadata["functions"], ["main", "helper", "phase"])
+        self.assertEqual(metadata["stack_traces"], [[(0, 10, 0), (1, 3, 1)]])
+    
+    def test_closed(self):
+        data = self._write()
+        metadata, events_offset = TraceFormat.parse_header(data)
+        self.assertEqual(events_offset, TraceFormat.HEADER_SIZE)
+        self._check_tables(metadata)
+        (metadata_offset,) = struct.unpack_from('<Q', data, TraceFormat.METADATA_OFFSET_POS)
+        self.assertGreater(metadata_offset, events_offset)
+        self._check_events(parse_events(data, events_offset, 1_500_000,
+                                        limit=metadata_offset - events_offset))
+    
+    def test_closed_compressed(self):
+        data = self._write(compress=True)
+        (flags,) = struct.unpack_from('<I', data, TraceFormat.FLAGS_POS)
+        self.assertTrue(flags & TraceFormat.FLAG_ZLIB)
+        metadata, events_offset = TraceFormat.parse_header(data)
+        self._check_tables(metadata)
+        (metadata_offset,) = struct.unpack_from('<Q', data, TraceFormat.METADATA_OFFSET_POS)
+        with open(self.path, 'rb') as f:
+            f.seek(events_offset)
+            summary = parse_events(bytearray(), 0, 1_500_000,
+                                   InflateReader(f, metadata_offset - events_offset))
+        self._check_events(summary)
+    
+    def test_never_closed(self):
+        data = self._write(close_tables=False)
+        metadata, events_offset = TraceFormat.parse_header(data)
+        self.assertEqual(metadata, {"stack_traces": [], "files": [], "functions": []})
+        self._check_events(parse_events(data, events_offset, 1_500_000))
+    
+    def test_version_1(self):
+        # Version 1 wrote JSON tables keyed by str(id) between header and events
+        fmt = TraceFormat()
+        metadata_json = json.dumps({
+            "stack_traces": {"0": [{"file_id": 0, "line": 10, "func_id": 0},
+                                   {"file_id": 1, "line": 3, "func_id": 1}]},
+            "files": {"0": "app.py", "1": "lib.py"},
+            "functions": {"0": "main", "1": "helper", "2": "phase"},
+        }).encode('utf-8')
+        header = bytearray(TraceFormat.HEADER_SIZE)
+        struct.pack_into('<4sIQI', header, 0, TraceFormat.MAGIC, 1, 1_500_000, len(metadata_json))
+        events = b"".join((
+            fmt.encode_alloc_event(5, 0x2000, 64, 0, 1),
+            fmt.encode_alloc_event(1, 0x1000, 32, 0, 1),
+            fmt.encode_free_event(1, 0x1000),
+            fmt.encode_gc_event(2, 7, 0),
+            bytes((EventType.MARKER, 3, 2)),
+        ))
+        data = bytes(header) + metadata_json + events
+        
+        metadata, events_offset = TraceFormat.parse_header(data)
+        self.assertEqual(events_offset, TraceFormat.HEADER_SIZE + len(metadata_json))
+        self._check_tables(metadata)
+        self._check_events(parse_events(data, events_offset, 1_500_000))
+
+
+class TruncatedStreamTest(unittest.TestCase):
+    """An event cut off by the end of the stream is reported, not misparsed."""
+    
+    def setUp(self):
+        fmt = TraceFormat()
+        self.events = fmt.encode_gc_event(2, 7, 0) + fmt.encode_alloc_event(1, 0x1000, 32, 0, 1)
+        self.cut = self.events[:-1]
+    
+    def test_in_memory(self):
+        for buf in (self.cut, bytearray(self.cut)):
+            with self.assertRaisesRegex(ValueError, "Truncated"):
+                parse_events(buf)
+    
+    def test_limit(self):
+        # The cut event would otherwise run on into the bytes after the limit
+        data = self.cut + bytes(64)
+        with self.assertRaisesRegex(ValueError, "Truncated"):
+            parse_events(data, limit=len(self.cut))
+    
+    def test_source(self):
+        with self.assertRaisesRegex(ValueError, "Truncated"):
+            parse_events(bytearray(), 0, 0, io.BytesIO(self.cut))
+    
+    def test_whole_events(self):
+        self.assertEqual(parse_events(self.events)["event_count"], 2)
+
+
+class WriterFlushTest(unittest.TestCase):
+    """Partial thread buffers reach the file before close()."""
+    
+    THREADS = 200
+    
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.writer = TraceWriter(os.path.join(self._tmp.name, "t.mlyze"))
+        self.writer.open(TraceFormat().create_header(1.5))
+    
+    def tearDown(self):
+        self.writer.close()
+        self._tmp.cleanup()
+    
+    def _wait_for(self, condition):
+        deadline = time.monotonic() + 5.0
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+    
+    def _write_gc_event(self):
+        slot, pos = self.writer.event_slot()
+        self.writer.commit_event(TraceFormat().encode_gc_event_into(slot, pos, 1, 0, 0))
+    
+    def test_first_slot_is_small(self):
+        self._write_gc_event()
+        with self.writer.lock:
+            (buf,) = self.writer._thread_buffers
+            self.assertLess(len(buf.data), self.writer.buffer_size)
+    
+    def test_growing_slot_keeps_events(self):
+        count = 5000  # Fills the first slot, then several full ones
+        for _ in range(count):
+            self._write_gc_event()
+        self.writer.close()
+        with open(self.writer.filepath, 'rb') as f:
+            data = f.read()
+        summary = parse_events(data, TraceFormat.HEADER_SIZE)
+        self.assertEqual(summary["gc_count"], count)
+    
+    def test_exited_threads(self):
+        for _ in range(self.THREADS):
+            t = threading.Thread(target=self._write_gc_event)
+            t.start()
+            t.join()
+        self._wait_for(lambda: self.writer.events_written == self.THREADS)
+        self.assertEqual(self.writer.events_written, self.THREADS)
+        with self.writer.lock:
+            self.assertEqual(self.writer._thread_buffers, [])
+    
+    def test_idle_thread(self):
+        self._write_gc_event()
+        time.sleep(0.2)  # Writer asks for a flush on its idle wait
+        self._write_gc_event()
+        self._wait_for(lambda: self.writer.events_written == 2)
+        self.assertEqual(self.writer.events_written, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
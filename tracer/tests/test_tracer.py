@@ -0,0 +1,140 @@
+"""
+Tests for the memory tracer.
+"""
+
+import contextlib
+import gc
+import io
+import os
+import struct
+import tempfile
+import threading
+import tracemalloc
+import unittest
+from unittest import mock
+
+from memlyze import tracer
+from memlyze._parse import parse_events
+from memlyze.format import TraceFormat
+
+
+def _read_trace(path):
+    """Return (metadata, summary) for a closed trace file."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    metadata, events_offset = TraceFormat.parse_header(data)
+    (metadata_offset,) = struct.unpack_from('<Q', data, TraceFormat.METADATA_OFFSET_POS)
+    return metadata, parse_events(data, events_offset, limit=metadata_offset - events_offset)
+
+
+class MarkFromThreadsTest(unittest.TestCase):
+    """mark() may run on any thread while the tracer writes other events."""
+    
+    THREADS = 4
+    MARKS = 3000
+    
+    def test_concurrent_marks(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "marks.mlyze")
+            errors = []
+            
+            def worker(n):
+                try:
+                    for _ in range(self.MARKS):
+                        tracer.mark(f"t{n}")
+                except Exception as e:
+                    errors.append(e)
+            
+            with contextlib.redirect_stdout(io.StringIO()):
+                tracer.start(path, track_gc=False)
+                try:
+                    threads = [threading.Thread(target=worker, args=(n,))
+                               for n in range(self.THREADS)]
+                    for t in threads:
+                        t.start()
+                    for t in threads:
+                        t.join()
+                finally:
+                    tracer.stop()
+            
+            self.assertEqual(errors, [])
+            _, summary = _read_trace(path)
+            self.assertEqual(summary["marker_count"], self.THREADS * self.MARKS)
+
+
+class NestedGCTest(unittest.TestCase):
+    """A collection during an encode must not overwrite the event being encoded."""
+    
+    MARKS = 200
+    
+    def test_gc_inside_encode(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "gc.mlyze")
+            with contextlib.redirect_stdout(io.StringIO()):
+                t = tracer.start(path)
+                
+                class CollectingFormat(TraceFormat):
+                    def encode_marker_event_into(self, *args):
+                        gc.collect()
+                        return super().encode_marker_event_into(*args)
+                t.format = CollectingFormat()
+                
+                for i in range(self.MARKS):
+                    t.mark(f"m{i}")
+                t.stop()
+            
+            _, summary = _read_trace(path)
+            self.assertEqual(summary["marker_count"], self.MARKS)
+            self.assertEqual(summary["gc_count"], t.stats["gc_events"])
+            self.assertGreaterEqual(summary["gc_count"], self.MARKS)
+            self.assertEqual(summary["event_count"], t.writer.events_written)
+
+
+class LowSampleRateTest(unittest.TestCase):
+    """Below a 1% sample rate most snapshot() calls skip the snapshot."""
+    
+    def test_snapshot_stride(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "low.mlyze")
+            with contextlib.redirect_stdout(io.StringIO()):
+                t = tracer.start(path, sample_rate=0.001, track_gc=False)
+                try:
+                    self.assertEqual(t.snapshot_stride, 10)
+                    with mock.patch.object(tracemalloc, "take_snapshot",
+                                           wraps=tracemalloc.take_snapshot) as take:
+                        for _ in range(25):
+                            t.snapshot()
+                        self.assertEqual(take.call_count, 2)
+                        t.stop()
+                        self.assertEqual(take.call_count, 3)
+                finally:
+                    t.stop()
+    
+    def test_full_rate_unchanged(self):
+        self.assertEqual(tracer.MemoryTracer(sample_rate=0.01).snapshot_stride, 1)
+        self.assertEqual(tracer.MemoryTracer(sample_rate=0.005).snapshot_stride, 2)
+
+
+class StopTest(unittest.TestCase):
+
+    def test_trace_closed_when_final_diff_fails(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "fail.mlyze")
+            with contextlib.redirect_stdout(io.StringIO()):
+                t = tracer.start(path, track_gc=False)
+                t.mark("before")
+                
+                def fail(current):
+                    raise ValueError("diff failed")
+                t._process_snapshot_diff = fail
+                with self.assertRaises(ValueError):
+                    t.stop()
+            
+            self.assertFalse(tracer.is_tracing())
+            metadata, summary = _read_trace(path)
+            self.assertEqual(summary["marker_count"], 1)
+            self.assertEqual(metadata["functions"], ["before"])
+
+
+if __name__ == "__main__":
+    unittest.main()